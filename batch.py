@@ -1,62 +1,385 @@
 from PySide6 import QtWidgets, QtGui, QtCore
 import pyqtgraph as pg
 import numpy as np
-from scipy.signal import savgol_filter as savgol
 import sys
 import os
-
-def calculate(filename,outfile,threshold,win):
-    f = open(filename)
-    fluo=[]
-    pmt=[]
-    time=[]
-    f.readline()
-    for riga in f:
-        tmptime,tmpfluo,tmppmt=[float(number) for number in riga.strip().split(',')[:3]]
-        time.append(tmptime)
-        fluo.append(tmpfluo)
-        pmt.append(tmppmt)
-    f.close()        
-
-    print(f'{len(time)}+1 lines read')
-
-    filtered = savgol(fluo,win,1)
-    block = np.where(filtered>threshold)
-    print(f'{len(block[0])} points isolated')
-
-    acqtimeus = int((time[1]-time[0])*1000)
-
-    time = np.array(time)[block]
-    fluo = np.array(fluo)[block]
-    pmt = np.array(pmt)[block]
-
-    peaks=[]
-    prevtime=0
-    tmp=[]
-    for i in range(1,len(time)):
-        tmptime = time[i]
-        tmpfluo = fluo[i]
-        if int((tmptime-prevtime)*1000) > acqtimeus:
-            if len(tmp)>win:
-                peaks.append(np.array(tmp))
-                tmp=[]                    
-        else:                
-            tmp.append([tmptime,tmpfluo])        
-        prevtime = tmptime
-    print(f'{len(peaks)} peaks identified')
-
-    intensity= []
-    duration = []
-    for p in peaks:
-        intensity.append(np.max(savgol(p[:,1],win,1)))
-        duration.append(p[-1,0]-p[0,0])
-
-    out = open(outfile,'w')
-    out.write('Duration [us],Intensity []a.u]\n')
-    for i in range(len(intensity)):
-        out.write(f'{duration[i]},{intensity[i]}\n')
-    out.close()
-    return duration, intensity
+import glob
+import time
+import json
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import engine
+import eventstore
+import profiling
+import resultcache
+import tracefile
+
+def runsegment(job):
+    filename,start,end,first,last,threshold,win,acqtimeus,features,keep,profile = job
+    if profile:
+        profiling.profile.reset()
+        profiling.enable(profile == 'allocations')
+    (time,fluo,pmt),before,after = tracefile.read_range(filename,start,end,win)
+    filtered = engine.smooth_segment(fluo,win,first,last)
+    owned = slice(before,len(time)-after)
+    segment = engine.segment_events(time[owned],fluo[owned],pmt[owned],filtered[owned],threshold,win,acqtimeus,
+                                    features,keep)
+    return len(time)-before-after, segment, profile and profiling.report()
+
+def segments(filename,events,win,acqtimeus,size,jobs):
+    # Line-aligned byte ranges are parsed and smoothed by the workers, with a
+    # window of context on each side; events crossing the seams are stitched
+    # back in file order, so the result matches the serial one bit for bit.
+    # The profiles of the workers are added to that of the run.
+    ranges = tracefile.line_ranges(filename,size)
+    profile = profiling.enabled() and ('allocations' if profiling.profile.allocations else 'time')
+    work = [(filename,start,end,k==0,k==len(ranges)-1,events.threshold,win,acqtimeus,events.features,events.keep,
+             profile) for k,(start,end) in enumerate(ranges)]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for samples,segment,report in pool.map(runsegment,work):
+            if report:
+                profiling.add(report)
+            yield events.join(samples,segment)
+
+def process(filename,outfile,threshold,win,chunksize=tracefile.CHUNK,jobs=1,features=engine.FEATURES,keep=False,
+            uniform=False,idle=None):
+    # The file is streamed in chunks of about chunksize bytes: memory stays
+    # bounded by the chunk size and events are written as soon as they close.
+    # With jobs>1 the chunks are processed in parallel worker processes.
+    # Columnar outputs (.npz, .parquet, .feather) are written in one go at
+    # the end, along with the samples of every event if keep is set.
+    # With uniform, the trace is read from its binary cache instead, with the
+    # times computed from the row index once its sampling has been checked.
+    # With idle, the trace is followed while it is written, until it has not
+    # grown for idle seconds, and the events are flushed as they close.
+    if idle is not None:
+        chunks = tracefile.follow(filename,idle=idle)
+        jobs = 1
+    elif uniform:
+        trace = tracefile.open_trace(filename,chunksize,uniform=True)
+        sampling = trace.meta['sampling']
+        for row,step in sampling['gaps']:
+            print(f'{filename}: sampling gap of {step} at row {row}')
+        if sampling['gapcount'] > len(sampling['gaps']):
+            print(f'{filename}: {sampling["gapcount"]-len(sampling["gaps"])} more gaps')
+        chunks = trace.chunks()
+        jobs = 1
+    elif jobs > 1:
+        # The workers parse the whole file: only its first samples are read here
+        acqtimeus = acquisition(filename)
+        events = engine.EventStream(threshold,win,acqtimeus,features,keep)
+        results = segments(filename,events,win,acqtimeus,chunksize,jobs)
+    else:
+        chunks = tracefile.read_chunks(filename,chunksize)
+    if jobs == 1:
+        first = next(chunks)
+        while len(first[0]) < 2:
+            first = tuple(np.concatenate(c) for c in zip(first,next(chunks)))
+        acqtimeus = int((first[0][1]-first[0][0])*1000)
+        events = engine.EventStream(threshold,win,acqtimeus,features,keep)
+        results = (events.feed(time,fluo,pmt,filtered)
+                   for time,fluo,pmt,filtered in engine.smooth_chunks(itertools.chain([first],chunks),win))
+
+    columnar = eventstore.table_format(outfile)
+    tables=[]
+    out = open(outfile,'w') if columnar is None else None
+    if out:
+        out.write(','.join(eventstore.HEADERS[name] for name in features)+'\n')
+    for table in results:
+        if out:
+            with profiling.stage('write'):
+                out.writelines(','.join(map(str,row))+'\n' for row in table.tolist())
+                if idle is not None and len(table):
+                    out.flush()
+        tables.append(table)
+    table = np.concatenate(tables)
+    with profiling.stage('write'):
+        if out:
+            out.close()
+        else:
+            eventstore.save_table(outfile,table,features)
+        if keep:
+            eventstore.save_samples(eventstore.samples_path(outfile),*engine.join_ragged(events.kept))
+    writeparams(filename,outfile,threshold,win,features,events.samples,events.count,uniform)
+    profiling.count('samples',events.samples)
+    profiling.count('points isolated',events.isolated)
+    profiling.count('events',events.count)
+    return events, table
+
+def paramsname(outfile):
+    return os.path.splitext(outfile)[0]+'.json'
+
+def writeparams(filename,outfile,threshold,win,features,samples,count,uniform=False):
+    # The parameters of the run, for catalog.py and uptodate()
+    with open(paramsname(outfile),'w') as f:
+        json.dump({'source':os.path.abspath(filename),'threshold':threshold,'window':win,'features':list(features),
+                   'uniform':uniform,'samples':samples,'events':count},f)
+
+def writetable(outfile,table,features):
+    if eventstore.table_format(outfile):
+        eventstore.save_table(outfile,table,features)
+        return
+    with open(outfile,'w') as out:
+        out.write(','.join(eventstore.HEADERS[name] for name in features)+'\n')
+        out.writelines(','.join(map(str,row))+'\n' for row in table.tolist())
+
+@profiling.timed('calculate')
+def calculate(filename,outfile,threshold,win,chunksize=tracefile.CHUNK,jobs=1):
+    events,table = process(filename,outfile,threshold,win,chunksize,jobs)
+    print(f'{events.samples}+1 lines read')
+    print(f'{events.isolated} points isolated')
+    print(f'{events.count} peaks identified')
+    return table[:,0], table[:,1]
+
+def outname(filename,format='csv'):
+    return os.path.splitext(filename)[0] + '_out.' + format
+
+def uptodate(filename,outfile,threshold,win,features=engine.FEATURES,keep=False,uniform=False):
+    # Newer than the trace, and from a run with the same parameters
+    if not os.path.exists(outfile) or os.path.getmtime(outfile) < os.path.getmtime(filename):
+        return False
+    if keep and not os.path.exists(eventstore.samples_path(outfile)):
+        return False
+    try:
+        with open(paramsname(outfile)) as f:
+            params = json.load(f)
+    except (OSError,ValueError):
+        return False
+    return (params.get('threshold'),params.get('window'),params.get('features'),params.get('uniform',False)) == \
+           (threshold,win,list(features),uniform)
+
+def acquisition(filename,uniform=False):
+    # The acqtimeus process() splits the events with, from the first two samples
+    if uniform:
+        time = tracefile.open_trace(filename,uniform=True).time[:2]
+    else:
+        chunks = tracefile.read_chunks(filename,1<<12)
+        time = next(chunks)[0]
+        while len(time) < 2:
+            time = np.concatenate((time,next(chunks)[0]))
+        chunks.close()
+    return int((time[1]-time[0])*1000)
+
+def expand(inputs):
+    # Directories contribute their CSV traces, skipping our own outputs
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            found = glob.glob(os.path.join(item,'*.csv'))
+        else:
+            found = glob.glob(item) or [item]
+        files += sorted(f for f in found if not f.endswith(('_out.csv','_processed.csv')))
+    return list(dict.fromkeys(files))
+
+def runfile(job):
+    # A file that fails is reported with its error instead of stopping the
+    # batch; its parameters are removed, so that a partial output is not
+    # taken for an up to date one by the next run.
+    filename,threshold,win,jobs,features,format,keep,uniform,profile,cache = job
+    if profile:
+        profiling.profile.reset()
+        profiling.enable(profile == 'allocations')
+    start = time.perf_counter()
+    try:
+        return analysefile(job,start)+(None,)
+    except Exception as error:
+        try:
+            os.remove(paramsname(outname(filename,format)))
+        except OSError:
+            pass
+        return filename,0,0,time.perf_counter()-start,profiling.report(),f'{type(error).__name__}: {error}'
+
+def analysefile(job,start):
+    filename,threshold,win,jobs,features,format,keep,uniform,profile,cache = job
+    outfile = outname(filename,format)
+    # Runs keeping the samples of the events are not cached
+    key = cache and not keep and resultcache.run_key(filename,threshold,win,acquisition(filename,uniform),features,
+                                                     uniform)
+    found = key and resultcache.ResultCache().get(key)
+    if found:
+        table,meta = found
+        with profiling.stage('write'):
+            writetable(outfile,table,features)
+            writeparams(filename,outfile,threshold,win,features,meta['samples'],len(table),uniform)
+        print(f'{filename}: cached result of a {meta["elapsed"]:.1f}s run')
+        return filename,meta['samples'],len(table),time.perf_counter()-start,profiling.report()
+    with profiling.stage('calculate'):
+        events,table = process(filename,outfile,threshold,win,jobs=jobs,features=features,keep=keep,uniform=uniform)
+    elapsed = time.perf_counter()-start
+    if key:
+        resultcache.ResultCache().put(key,table,{'source':os.path.abspath(filename),'threshold':threshold,'window':win,
+                                                 'features':list(features),'uniform':uniform,'samples':events.samples,
+                                                 'events':events.count,'elapsed':elapsed})
+    return filename,events.samples,events.count,elapsed,profiling.report()
+
+def runbatch(files,threshold,win,jobs=None,force=False,summary='batch_summary.csv',profile=None,allocations=False,
+             features=engine.FEATURES,format='csv',keep=False,uniform=False,cache=True):
+    todo = [f for f in files if force or not uptodate(f,outname(f,format),threshold,win,features,keep,uniform)]
+    for f in files:
+        if f not in todo:
+            print(f'{f}: up to date, skipped')
+    start = time.perf_counter()
+    profiled = profile and ('allocations' if allocations else 'time')
+    if len(todo) == 1:
+        # A single trace is split across the cores instead
+        results = [runfile((todo[0],threshold,win,jobs or os.cpu_count(),features,format,keep,uniform,profiled,cache))]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(runfile,[(f,threshold,win,1,features,format,keep,uniform,profiled,cache) for f in todo]))
+    reports = {r[0]: r[4] for r in results}
+    results = [r[:4]+r[5:] for r in results]
+    for filename,samples,count,elapsed,error in results:
+        if error:
+            print(f'{filename}: failed, {error}',file=sys.stderr)
+        else:
+            print(f'{filename}: {samples} samples, {count} peaks in {elapsed:.1f}s')
+    elapsed = time.perf_counter()-start
+    samples = sum(r[1] for r in results)
+    count = sum(r[2] for r in results)
+    failed = [r[0] for r in results if r[4]]
+    with open(summary,'w') as out:
+        out.write('File,Samples,Peaks,Elapsed [s],Throughput [samples/s],Error\n')
+        for filename,s,c,e,error in results:
+            error = '"'+error.replace('"','""')+'"' if error else ''
+            out.write(f'{filename},{s},{c},{e},{s/e if e else 0},{error}\n')
+        out.write(f'TOTAL,{samples},{count},{elapsed},{samples/elapsed if elapsed else 0},{len(failed)} failed\n')
+    print(f'{len(results)-len(failed)} files processed ({len(files)-len(todo)} skipped, {len(failed)} failed), '
+          f'{count} peaks, {elapsed:.1f}s, {samples/elapsed if elapsed else 0:.0f} samples/s')
+    for filename in failed:
+        print(f'failed: {filename}',file=sys.stderr)
+    if profile:
+        with open(profile,'w') as out:
+            json.dump({'files': reports, 'total': profiling.merge(reports.values())},out,indent=1)
+        print(profiling.summary(profiling.merge(reports.values())))
+    return results
+
+def preparefile(job):
+    filename,uniform = job
+    return tracefile.open_trace(filename,uniform=uniform).rows
+
+def gridwindow(job):
+    # One smoothing per window, streamed chunk by chunk through an event
+    # stream per threshold, so that memory stays bounded by the chunk size
+    filename,win,thresholds,features,uniform,cache = job
+    start = time.perf_counter()
+    trace = tracefile.open_trace(filename,uniform=uniform)
+    acqtimeus = int((trace.time[1]-trace.time[0])*1000)
+    cache = cache and resultcache.ResultCache()
+    keys = [resultcache.run_key(filename,threshold,win,acqtimeus,features,uniform)
+            for threshold in thresholds] if cache else []
+    found = [cache.get(key) for key in keys]
+    if found and all(found):
+        return filename,win,[table for table,meta in found]
+    streams = [engine.EventStream(threshold,win,acqtimeus,features) for threshold in thresholds]
+    parts = [[] for threshold in thresholds]
+    for chunk in engine.smooth_chunks(trace.chunks(),win):
+        for events,tables in zip(streams,parts):
+            tables.append(events.feed(*chunk))
+    tables = [np.concatenate(tables) for tables in parts]
+    elapsed = time.perf_counter()-start
+    for threshold,key,table in zip(thresholds,keys,tables):
+        cache.put(key,table,{'source':os.path.abspath(filename),'threshold':threshold,'window':win,
+                             'features':list(features),'uniform':uniform,'samples':trace.rows,'events':len(table),
+                             'elapsed':elapsed})
+    return filename,win,tables
+
+def gridcolumns(parts,features):
+    # The tidy table of the (file, window, threshold, table) parts: one row
+    # per event, with its parameters as columns
+    sizes = [len(t) for f,w,th,t in parts]
+    columns = {'trace': np.repeat([f for f,w,th,t in parts],sizes).astype(str),
+               'window': np.repeat([w for f,w,th,t in parts],sizes).astype(int),
+               'threshold': np.repeat([th for f,w,th,t in parts],sizes).astype(int),
+               'event': np.concatenate([np.arange(n) for n in sizes]) if parts else np.empty(0,int)}
+    table = np.concatenate([t for f,w,th,t in parts]) if parts else np.empty((0,len(features)))
+    columns.update({name: table[:,k] for k,name in enumerate(features)})
+    return columns
+
+@profiling.timed('grid')
+def rungrid(files,thresholds,windows,outfile,jobs=None,features=engine.FEATURES,uniform=False,cache=True):
+    # Every trace is parsed once, into its binary cache, and every window is
+    # smoothed once in its own worker process; the events of all the
+    # (file, window, threshold) combinations go to one table with the
+    # parameters as columns.
+    start = time.perf_counter()
+    columnar = eventstore.table_format(outfile)
+    parts = []
+    out = open(outfile,'w') if columnar is None else None
+    if out:
+        out.write(','.join(('trace','window','threshold','event')+tuple(features))+'\n')
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for filename,rows in zip(files,pool.map(preparefile,[(f,uniform) for f in files])):
+            print(f'{filename}: {rows} samples')
+        work = [(f,win,thresholds,features,uniform,cache) for f in files for win in windows]
+        for filename,win,tables in pool.map(gridwindow,work):
+            print(f'{filename}: window {win}, '+', '.join(f'{len(t)} peaks at {th}' for th,t in zip(thresholds,tables)))
+            for threshold,table in zip(thresholds,tables):
+                if out:
+                    with profiling.stage('write'):
+                        out.writelines(f'{filename},{win},{threshold},{k},'+','.join(map(str,row))+'\n'
+                                       for k,row in enumerate(table.tolist()))
+                else:
+                    parts.append((filename,win,threshold,table))
+    with profiling.stage('write'):
+        if out:
+            out.close()
+        else:
+            eventstore.save_columns(outfile,gridcolumns(parts,features))
+    print(f'{len(files)} files x {len(windows)} windows x {len(thresholds)} thresholds in '
+          f'{time.perf_counter()-start:.1f}s, written to {outfile}')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Isolate the fluorescence peaks of many traces in parallel.')
+    parser.add_argument('inputs',nargs='+',help='CSV traces, directories or glob patterns')
+    parser.add_argument('-t','--threshold',type=int,default=4000)
+    parser.add_argument('-w','--window',type=int,default=31)
+    parser.add_argument('-j','--jobs',type=int,default=None,help='worker processes (default: all cores)')
+    parser.add_argument('-f','--force',action='store_true',help='reprocess files whose output is up to date')
+    parser.add_argument('--summary',default='batch_summary.csv')
+    parser.add_argument('--features',nargs='+',choices=engine.FEATURES,default=engine.FEATURES,
+                        help='columns of the output files (default: all)')
+    parser.add_argument('--format',choices=('csv',)+eventstore.FORMATS,default='csv',
+                        help='format of the output files; parquet and feather need pyarrow')
+    parser.add_argument('--samples',action='store_true',
+                        help='also save the samples of every event to <output>_samples.npz')
+    parser.add_argument('--follow',type=float,metavar='IDLE',
+                        help='analyse a single trace while it is written, until it has not grown for IDLE seconds')
+    parser.add_argument('--uniform',action='store_true',
+                        help='read the traces through their binary cache, computing the times of '
+                             'uniformly sampled ones instead of storing them')
+    parser.add_argument('--grid',metavar='OUTPUT',
+                        help='find the events for every threshold and window given, into one table')
+    parser.add_argument('--thresholds',type=int,nargs='+',help='thresholds of the grid (default: -t)')
+    parser.add_argument('--windows',type=int,nargs='+',help='window sizes of the grid (default: -w)')
+    parser.add_argument('--no-cache',dest='cache',action='store_false',
+                        help='neither use nor fill the cache of past results (see resultcache.py)')
+    parser.add_argument('--profile',help='write a JSON report of the time spent in each stage')
+    parser.add_argument('--allocations',action='store_true',help='also trace the memory allocated by each stage')
+    args = parser.parse_args(argv)
+    windows = args.windows or [args.window]
+    if any(win % 2 == 0 for win in windows+[args.window]):
+        parser.error('window size must be an odd number')
+    files = [f for f in expand(args.inputs) if os.path.abspath(f) != os.path.abspath(args.summary)]
+    if not files:
+        parser.error('no input files found')
+    if args.follow is not None:
+        if len(files) != 1:
+            parser.error('--follow takes a single trace')
+        outfile = outname(files[0],args.format)
+        events,table = process(files[0],outfile,args.threshold,args.window,features=tuple(args.features),
+                               keep=args.samples,idle=args.follow)
+        print(f'{files[0]}: {events.samples} samples, {events.count} peaks written to {outfile}')
+        return
+    if args.grid:
+        rungrid(files,args.thresholds or [args.threshold],windows,args.grid,args.jobs,tuple(args.features),
+                args.uniform,args.cache)
+        return
+    results = runbatch(files,args.threshold,args.window,args.jobs,args.force,args.summary,args.profile,
+                       args.allocations,tuple(args.features),args.format,args.samples,args.uniform,args.cache)
+    if any(error for filename,samples,count,elapsed,error in results):
+        return 1
 
 class MainWindow(QtWidgets.QMainWindow):
     def __init__(self):
@@ -109,8 +432,7 @@ class MainWindow(QtWidgets.QMainWindow):
         filename, _ = QtWidgets.QFileDialog.getOpenFileName(self, 'Select Input File', '', 'CSV Files (*.csv)')
         if filename:
             self.infile_edit.setText(filename)
-            outfile = os.path.splitext(filename)[0] + '_out.csv'
-            self.outfile_edit.setText(outfile)
+            self.outfile_edit.setText(outname(filename))
 
     def calculate(self):
         infile = self.infile_edit.text()
@@ -131,6 +453,8 @@ class MainWindow(QtWidgets.QMainWindow):
         self.plot_widget.plot(x, y, pen=None, symbol='o')
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(main())
     app = QtWidgets.QApplication(sys.argv)
     main_window = MainWindow()
     main_window.show()
@@ -0,0 +1,188 @@
+import argparse
+import importlib
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import eventstore
+import profiling
+import resultcache
+import tracefile
+
+# Benchmarks of the batch.py and zoomer.py pipelines on synthetic traces.
+# A trace is a time [ms],fluo,PMT CSV like the Zeiss exports: Gaussian noise
+# on a baseline with rectangular fluorescence bursts of known position, so
+# that the events found can be checked against the ground truth.
+
+
+def generate(filename, samples, rate=400000, noise=300, density=200, amplitude=(2000, 8000),
+             width=(20, 200), baseline=1000, seed=0, chunk=1 << 20):
+    """Write a synthetic trace and return its ground truth events.
+
+    rate is the sampling rate in Hz, density the mean number of events per
+    second of trace and width their range of lengths in samples. Returns the
+    (start, stop) sample ranges and the amplitudes of the events.
+    """
+    rng = np.random.default_rng(seed)
+    dt = 1000 / rate
+    count = rng.poisson(density * samples / rate)
+    starts = np.sort(rng.integers(0, max(samples - width[1], 1), count))
+    # Keep the events apart so that each one is a separate burst
+    if len(starts):
+        starts = starts[np.concatenate(([True], np.diff(starts) > 2 * width[1]))]
+    stops = starts + rng.integers(width[0], width[1], len(starts))
+    heights = rng.uniform(*amplitude, len(starts))
+    with open(filename, 'w') as f:
+        f.write('Time [ms],Fluo,PMT\n')
+        for a in range(0, samples, chunk):
+            b = min(a + chunk, samples)
+            fluo = rng.normal(baseline, noise, b - a)
+            pmt = rng.normal(baseline / 2, noise / 3, b - a)
+            first, last = np.searchsorted(stops, a), np.searchsorted(starts, b)
+            for start, stop, height in zip(starts[first:last], stops[first:last], heights[first:last]):
+                lo, hi = max(start, a) - a, min(stop, b) - a
+                fluo[lo:hi] += height
+                pmt[lo:hi] += height / 4
+            data = np.column_stack(((a + np.arange(b - a)) * dt, np.round(fluo), np.round(pmt)))
+            np.savetxt(f, data, fmt=['%.6f', '%d', '%d'], delimiter=',')
+    return np.column_stack((starts, stops)), heights
+
+
+# The benchmark stages, from the stages profiling records inside the real
+# entry points; the time left outside all of them is reported as other
+GROUPS = {'parse': ('parse', 'cache', 'pyramid'), 'smooth': ('smooth',), 'isolate': ('rank', 'mask'),
+          'features': ('split', 'features', 'calculateFeatures'), 'export': ('write',)}
+
+
+def stage_seconds(report, elapsed):
+    """Seconds of each of GROUPS in a profiling report, plus the rest of elapsed."""
+    own = {name: entry['self'] for name, entry in report['stages'].items()}
+    seconds = {group: sum(own.pop(name, 0) for name in names) for group, names in GROUPS.items()}
+    seconds['other'] = elapsed - sum(seconds.values())
+    return seconds
+
+
+def event_rows(time, first, last, rate):
+    """(start, stop) sample ranges of the events from the times of their first and last samples."""
+    dt = 1000 / rate
+    return np.column_stack((np.rint(np.asarray(time[first]) / dt), np.rint(np.asarray(time[last]) / dt) + 1)).astype(int)
+
+
+def batch_pipeline(filename, outfile, threshold, win, rate):
+    """batch.process(), keeping the samples of the events to place them in the trace."""
+    import batch
+    events, table = batch.process(filename, outfile, threshold, win, keep=True)
+    values, offsets, names = eventstore.load_samples(eventstore.samples_path(outfile))
+    return events.samples, events.count, event_rows(values[:, 0], offsets[:-1], offsets[1:] - 1, rate)
+
+
+def zoomer_pipeline(filename, outfile, threshold, win, rate):
+    """zoomer.py's open, isolate and save, without showing the window."""
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PySide6.QtWidgets import QApplication
+    import zoomer
+    app = QApplication.instance() or QApplication([])
+    window = zoomer.MyApp()
+    window.filename = filename
+    report = lambda fraction, message: None
+    window.setTrace(window.openTrace(filename, report))
+    window.setIsolated(window.isolate(win, threshold, report))
+    window.writeData(outfile, win, report)
+    return window.trace.rows, len(window.starts), event_rows(window.xtime, window.starts, window.ends - 1, rate)
+
+
+def measure(job):
+    """Run one pipeline, in its own process so that its peak RSS is its own.
+
+    The trace cache and the cache of results are removed first, so that
+    every stage runs.
+    """
+    pipeline, filename, outfile, threshold, win, rate = job
+    shutil.rmtree(tracefile.cache_path(filename), ignore_errors=True)
+    resultcache.DIRECTORY = tempfile.mkdtemp(prefix='zmresults')
+    # Each pipeline is named after its module, imported before the timing
+    importlib.import_module(pipeline)
+    profiling.enable()
+    start = time.perf_counter()
+    try:
+        samples, count, found = PIPELINES[pipeline](filename, outfile, threshold, win, rate)
+    finally:
+        elapsed = time.perf_counter() - start
+        shutil.rmtree(resultcache.DIRECTORY, ignore_errors=True)
+        shutil.rmtree(tracefile.cache_path(filename), ignore_errors=True)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return stage_seconds(profiling.report(), elapsed), samples, count, found, rss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def matches(truth, found):
+    """Fraction of the truth events overlapped by a found one, and vice versa."""
+    if len(truth) == 0 or len(found) == 0:
+        return 0.0, 0.0
+    def overlapped(a, b):
+        # a[k] overlaps some interval of b iff one starts before a[k] ends
+        # and the last such one ends after a[k] starts
+        last = np.searchsorted(b[:, 0], a[:, 1], side='left') - 1
+        return (last >= 0) & (b[np.maximum(last, 0), 1] > a[:, 0])
+    return overlapped(truth, found).mean(), overlapped(found, truth).mean()
+
+
+PIPELINES = {'batch': batch_pipeline, 'zoomer': zoomer_pipeline}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the peak isolation pipelines on a synthetic trace.')
+    parser.add_argument('-n', '--samples', type=float, default=1e6)
+    parser.add_argument('--rate', type=float, default=400000, help='sampling rate [Hz]')
+    parser.add_argument('--noise', type=float, default=300)
+    parser.add_argument('--density', type=float, default=200, help='events per second of trace')
+    parser.add_argument('-t', '--threshold', type=int, default=2500)
+    parser.add_argument('-w', '--window', type=int, default=31)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--pipelines', nargs='+', choices=sorted(PIPELINES), default=sorted(PIPELINES))
+    parser.add_argument('--dir', help='where to write the trace (default: a temporary directory)')
+    parser.add_argument('--log', help='append the results as JSON lines to this file')
+    args = parser.parse_args(argv)
+    samples = int(args.samples)
+
+    workdir = args.dir or tempfile.mkdtemp(prefix='zmbench')
+    os.makedirs(workdir, exist_ok=True)
+    filename = os.path.join(workdir, f'synthetic_{samples}.csv')
+    start = time.perf_counter()
+    truth, heights = generate(filename, samples, args.rate, args.noise, args.density, seed=args.seed)
+    print(f'{samples} samples, {len(truth)} events generated in {time.perf_counter()-start:.1f}s '
+          f'({os.path.getsize(filename)/1e6:.0f} MB)')
+
+    records = []
+    for pipeline in args.pipelines:
+        outfile = os.path.join(workdir, f'synthetic_{samples}_{pipeline}.csv')
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            seconds, count_samples, count, found, rss = pool.submit(
+                measure, (pipeline, filename, outfile, args.threshold, args.window, args.rate)).result()
+        total = sum(seconds.values())
+        record = {'pipeline': pipeline, 'samples': count_samples, 'events': int(count), 'truth': len(truth),
+                  'seconds': seconds, 'total': total, 'throughput': count_samples / total, 'peak_rss': rss,
+                  'threshold': args.threshold, 'window': args.window}
+        record['recall'], record['precision'] = matches(truth, found)
+        records.append(record)
+        print(f'\n{pipeline}: {count} events of {len(truth)}, {total:.2f}s, '
+              f'{record["throughput"]/1e6:.2f} Msamples/s, peak RSS {rss/2**20:.0f} MB')
+        for stage, value in seconds.items():
+            print(f'  {stage:10s} {value:8.3f}s')
+        print(f'  recall {record["recall"]:.3f}, precision {record["precision"]:.3f}')
+    if args.log:
+        with open(args.log, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+    if not args.dir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
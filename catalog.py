@@ -0,0 +1,234 @@
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+
+import numpy as np
+
+import engine
+import eventstore
+
+# Persistent SQLite index of the event tables found under a results tree,
+# so that the events of many runs can be selected by position and date
+# without reading every output again. A run is one output file of batch.py
+# (<trace>_out.*) or zoomer.py (<trace>_processed.*); its position and date
+# are taken from its path and its parameters from the <output>.json written
+# next to it by batch.py, when present. The features of zoomer.py, saved
+# in its own units, are stored in those of batch.py. update() only reads the
+# outputs that are new or changed since the last scan and drops those removed.
+
+DATABASE = 'zmicro_catalog.sqlite'
+SUFFIXES = ('_out', '_processed')
+EXTENSIONS = ('.csv',) + tuple('.' + f for f in eventstore.FORMATS)
+DATE = re.compile(r'(?<!\d)(\d{4})[-_]?(\d{2})[-_]?(\d{2})(?!\d)')
+POSITION = re.compile(r'(?i)(?:^|[^a-z])(pos(?:ition)?[-_ ]?\d+|junction)')
+
+SCHEMA = '''
+create table if not exists runs (
+    id integer primary key,
+    path text unique not null,
+    size integer not null,
+    mtime integer not null,
+    trace text,
+    position text,
+    date text,
+    threshold real,
+    window integer,
+    events integer not null
+);
+create index if not exists runs_position on runs (position, date);
+create table if not exists events (
+    run integer not null references runs (id) on delete cascade,
+    {columns}
+);
+create index if not exists events_run on events (run);
+'''.format(columns=',\n    '.join(f'{name} real' for name in engine.FEATURES))
+
+
+def connect(path):
+    db = sqlite3.connect(path)
+    db.execute('pragma foreign_keys = on')
+    db.executescript(SCHEMA)
+    return db
+
+
+def is_output(filename):
+    stem, extension = os.path.splitext(filename)
+    return extension.lower() in EXTENSIONS and stem.endswith(SUFFIXES)
+
+
+def describe(path, root):
+    """Trace name, position and date of an output, from its path below root."""
+    relative = os.path.relpath(path, root)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    trace = re.sub('|'.join(SUFFIXES) + '$', '', stem)
+    date = DATE.search(relative)
+    positions = POSITION.findall(relative)
+    position = re.sub('[-_ ]', '', positions[-1].lower()).replace('position', 'pos') if positions else None
+    return trace, position, '-'.join(date.groups()) if date else None
+
+
+def read_output(path):
+    """Feature names and (events, features) table of an output file."""
+    if eventstore.table_format(path):
+        frame = eventstore.load_table(path)
+        return [str(name) for name in frame.columns], frame.to_numpy(dtype=float)
+    with open(path) as f:
+        header = f.readline().rstrip('\n').split(',')
+    names = {label: name for name, label in eventstore.HEADERS.items()}
+    # The label of the same ms durations in the outputs of older versions
+    names['Duration [us]'] = 'duration'
+    if all(label in names for label in header):
+        table = np.loadtxt(path, delimiter=',', skiprows=1, ndmin=2)
+        return [names[label] for label in header], table
+    # zoomer.py writes no header: the full feature set, or the two columns
+    # of the outputs saved before the others existed
+    table = np.loadtxt(path, delimiter=',', ndmin=2)
+    return list(engine.FEATURES[:table.shape[1]] if table.shape[1] in (2, len(engine.FEATURES)) else []), table
+
+
+def parameters(path):
+    try:
+        with open(os.path.splitext(path)[0] + '.json') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def scan(root):
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories[:] = sorted(d for d in subdirectories if not d.endswith('.zmc'))
+        for filename in sorted(files):
+            if is_output(filename):
+                yield os.path.join(directory, filename)
+
+
+def update(db, root, progress=None):
+    """Index the new and changed outputs under root; returns (added, removed) counts."""
+    known = {path: (size, mtime) for path, size, mtime in db.execute('select path, size, mtime from runs')}
+    found = set()
+    added = 0
+    for path in scan(root):
+        path = os.path.abspath(path)
+        found.add(path)
+        st = os.stat(path)
+        if known.get(path) == (st.st_size, st.st_mtime_ns):
+            continue
+        names, table = read_output(path)
+        names = [name for name in names if name in engine.FEATURES]
+        if not names:
+            print(f'{path}: columns not recognised, skipped', file=sys.stderr)
+            with db:
+                db.execute('delete from runs where path = ?', (path,))
+            continue
+        table = table[:, :len(names)]
+        if os.path.splitext(path)[0].endswith('_processed'):
+            table = table / [eventstore.SCALE if name in eventstore.SCALED else 1 for name in names]
+        trace, position, date = describe(path, root)
+        params = parameters(path)
+        with db:
+            db.execute('delete from runs where path = ?', (path,))
+            run = db.execute('insert into runs (path, size, mtime, trace, position, date, threshold, window, events) '
+                             'values (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             (path, st.st_size, st.st_mtime_ns, trace, position, date,
+                              params.get('threshold'), params.get('window'), len(table))).lastrowid
+            db.executemany(f'insert into events (run, {", ".join(names)}) values (?{", ?" * len(names)})',
+                           ((run, *row) for row in table.tolist()))
+        added += 1
+        if progress is not None:
+            progress(path, len(table))
+    root = os.path.abspath(root)
+    gone = [path for path in known if path not in found and path.startswith(root + os.sep)]
+    with db:
+        db.executemany('delete from runs where path = ?', ((path,) for path in gone))
+    return added, len(gone)
+
+
+def query(db, feature, positions=None, dates=None, threshold=None, window=None):
+    """(position, date, trace, value) of the feature of every event matching the filters.
+
+    positions and dates are lists of values; dates may also be a (first,
+    last) range given as a tuple.
+    """
+    if feature not in engine.FEATURES:
+        raise ValueError(f'unknown feature {feature}')
+    where, args = [], []
+    if positions:
+        where.append(f'runs.position in ({", ".join("?" * len(positions))})')
+        args += list(positions)
+    if isinstance(dates, tuple):
+        where.append('runs.date between ? and ?')
+        args += list(dates)
+    elif dates:
+        where.append(f'runs.date in ({", ".join("?" * len(dates))})')
+        args += list(dates)
+    for column, value in (('threshold', threshold), ('window', window)):
+        if value is not None:
+            where.append(f'runs.{column} = ?')
+            args.append(value)
+    sql = (f'select runs.position, runs.date, runs.trace, events.{feature} from events join runs on events.run = runs.id'
+           f' where events.{feature} is not null' + ''.join(' and ' + w for w in where) +
+           ' order by runs.position, runs.date, runs.trace, events.rowid')
+    return db.execute(sql, args).fetchall()
+
+
+def wide(rows):
+    """One column per position, as the tables read by analyser.py."""
+    columns = {}
+    for position, date, trace, value in rows:
+        columns.setdefault(position or trace, []).append(value)
+    length = max(map(len, columns.values()), default=0)
+    table = np.full((length, len(columns)), np.nan)
+    for k, values in enumerate(columns.values()):
+        table[:len(values), k] = values
+    return list(columns), table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Index the event tables of a results tree and query them.')
+    parser.add_argument('--db', help=f'index file (default: <root>/{DATABASE} or ./{DATABASE})')
+    commands = parser.add_subparsers(dest='command', required=True)
+    scanning = commands.add_parser('update', help='index the new and changed outputs under root')
+    scanning.add_argument('root')
+    asking = commands.add_parser('query', help='print or save the events of a feature')
+    asking.add_argument('feature', choices=engine.FEATURES)
+    asking.add_argument('-p', '--position', nargs='+')
+    asking.add_argument('-d', '--date', nargs='+', help='dates, or FIRST..LAST')
+    asking.add_argument('-t', '--threshold', type=float)
+    asking.add_argument('-w', '--window', type=int)
+    asking.add_argument('-o', '--output', help='write a table with one column per position (CSV or columnar)')
+    commands.add_parser('runs', help='list the indexed runs')
+    args = parser.parse_args(argv)
+
+    db = connect(args.db or os.path.join(args.root if args.command == 'update' else '.', DATABASE))
+    if args.command == 'update':
+        added, removed = update(db, args.root, lambda path, count: print(f'{path}: {count} events'))
+        print(f'{added} outputs indexed, {removed} removed')
+    elif args.command == 'runs':
+        for row in db.execute('select position, date, trace, threshold, window, events, path from runs '
+                              'order by position, date, trace'):
+            print(','.join('' if v is None else str(v) for v in row))
+    else:
+        dates = args.date
+        if dates and len(dates) == 1 and '..' in dates[0]:
+            dates = tuple(dates[0].split('..', 1))
+        rows = query(db, args.feature, args.position, dates, args.threshold, args.window)
+        if args.output:
+            names, table = wide(rows)
+            if eventstore.table_format(args.output):
+                eventstore.save_table(args.output, table, names)
+            else:
+                with open(args.output, 'w') as f:
+                    f.write(','.join(names) + '\n')
+                    for row in table.tolist():
+                        f.write(','.join('' if v != v else str(v) for v in row) + '\n')
+            print(f'{len(rows)} values of {len(names)} positions written to {args.output}')
+        else:
+            for row in rows:
+                print(','.join('' if v is None else str(v) for v in row))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,546 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+from scipy.ndimage import convolve1d
+from scipy.signal import savgol_coeffs
+
+import profiling
+
+# Headless peak-isolation engine shared by batch.py and zoomer.py.
+# A trace is thresholded on its smoothed fluorescence, the samples above
+# threshold are split into events wherever the time jumps by more than one
+# acquisition step, and each event is reduced to a row of features: its
+# duration and smoothed maximum intensity, and optionally its area, width,
+# rise and fall times and the peak of its PMT signal.
+# The smoothing is savgol(x, win, 1) with mode='interp': with a polynomial
+# of order 1 it is the centred moving average of win samples, with the
+# first and last win//2 points taken from the straight lines fitted to the
+# first and last win samples. The sums of integer samples, the counts of
+# the instrument, are exact with running sums, which makes the smoothing
+# O(1) per sample and independent of where a trace is cut into chunks or
+# segments; other samples are convolved as savgol does.
+
+FEATURES = ('duration', 'intensity', 'area', 'fwhm', 'rise', 'fall', 'pmt', 'ratio')
+
+
+def check_window(win, length=None):
+    if win < 3 or win % 2 == 0:
+        raise ValueError(f'window size must be odd and at least 3, not {win}')
+    if length is not None and length < win:
+        raise ValueError(f'window size {win} is longer than the {length} samples')
+
+
+def window_means(values, win):
+    """Means of the win samples centred on each of values[win//2:len(values)-win//2]."""
+    values = np.asarray(values, dtype=float)
+    if len(values) < win:
+        return np.empty(0)
+    if len(values) * np.abs(values).max() < 2**53 and np.all(values == np.floor(values)):
+        # Integers this small add up exactly in float64
+        sums = np.zeros(len(values) + 1)
+        np.cumsum(values, out=sums[1:])
+        means = sums[win:] - sums[:-win]
+        means /= win
+        return means
+    half = win // 2
+    return convolve1d(values, savgol_coeffs(win, 1), mode='constant')[half:len(values) - half]
+
+
+def edge_lines(values, centres, win, left):
+    """The first (left) or last win//2 points of the lines fitted to the win samples around centres.
+
+    Returns a (len(centres), win//2) array, each line being the mean of its
+    samples at the centre plus its least-squares slope times the offset.
+    """
+    half = win // 2
+    offsets = np.arange(-half, half + 1)
+    windows = np.asarray(values, dtype=float)[np.asarray(centres)[:, None] + offsets]
+    slopes = (windows * (offsets / np.sum(offsets * offsets))).sum(axis=1)
+    means = windows.sum(axis=1) / win
+    steps = offsets[:half] if left else offsets[half + 1:]
+    return means[:, None] + steps * slopes[:, None]
+
+
+@profiling.timed('smooth')
+def smooth_segment(fluo, win, first=True, last=True):
+    """Smooth a slice of a trace that carries win samples of context.
+
+    The edge fit is only applied at the ends flagged as the ends of the
+    trace, the others are left NaN; elsewhere the context makes the result
+    that of smooth() on the whole trace.
+    """
+    check_window(win, len(fluo) if first or last else None)
+    half = win // 2
+    filtered = np.full(len(fluo), np.nan)
+    filtered[half:len(fluo) - half] = window_means(fluo, win)
+    if first:
+        filtered[:half] = edge_lines(fluo, [half], win, True)[0]
+    if last:
+        filtered[len(fluo) - half:] = edge_lines(fluo, [len(fluo) - 1 - half], win, False)[0]
+    return filtered
+
+
+def smooth(values, win):
+    """savgol(values, win, 1) of a whole trace."""
+    return smooth_segment(values, win)
+
+
+class MovingAverage:
+    """Streaming counterpart of smooth(), fed a trace in consecutive chunks.
+
+    feed() returns the smoothed values that are final so far and close()
+    the last win//2 of them. Only the last win samples are carried over.
+    """
+
+    def __init__(self, win):
+        check_window(win)
+        self.win = win
+        self.tail = np.empty(0)
+        self.started = False
+
+    def feed(self, values):
+        values = np.concatenate((self.tail[1:] if self.started else self.tail, np.asarray(values, dtype=float)))
+        if len(values) < self.win:
+            self.tail = values
+            return np.empty(0)
+        with profiling.stage('smooth'):
+            means = window_means(values, self.win)
+            if not self.started:
+                means = np.concatenate((edge_lines(values, [self.win // 2], self.win, True)[0], means))
+                self.started = True
+        self.tail = values[-self.win:]
+        return means
+
+    def close(self):
+        if not self.started:
+            return smooth(self.tail, self.win)
+        return edge_lines(self.tail, [self.win // 2], self.win, False)[0]
+
+
+@profiling.timed('mask')
+def isolate(filtered, threshold):
+    """Indices of the samples whose smoothed value lies above threshold."""
+    return np.flatnonzero(np.asarray(filtered) > threshold)
+
+
+class RankedSignal:
+    """A smoothed trace with the order of its values, for repeated thresholds.
+
+    Sorting costs O(n log n) once; above() then finds the k samples over any
+    threshold with a binary search and sorts only those back in trace order.
+    """
+
+    @profiling.timed('rank')
+    def __init__(self, filtered):
+        self.filtered = np.asarray(filtered)
+        self.order = np.argsort(self.filtered, kind='stable')
+        if len(self.order) < 2**32:
+            # Half the memory of the default int64 indices
+            self.order = self.order.astype(np.uint32)
+
+    def rank(self, threshold):
+        """Number of samples not above threshold."""
+        lo, hi = 0, len(self.order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.filtered[self.order[mid]] > threshold:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    @profiling.timed('mask')
+    def above(self, threshold):
+        """Same as isolate(filtered, threshold)."""
+        return np.sort(self.order[self.rank(threshold):])
+
+
+class SmoothCache:
+    """The RankedSignal of the last few (trace, window) pairs."""
+
+    def __init__(self, size=2):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key, compute):
+        """The entry for key, computing it as RankedSignal(compute()) if missing."""
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        else:
+            self.entries[key] = RankedSignal(compute())
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+
+def gaps(time, prevtime, acqtimeus):
+    """Flag the samples more than one acquisition step after their predecessor."""
+    prev = np.empty(len(time))
+    prev[:1] = prevtime
+    prev[1:] = time[:-1]
+    return np.trunc((time - prev) * 1000) > acqtimeus
+
+
+def runs(bounds, win):
+    """(starts, ends) of the runs closed by the gap positions in bounds."""
+    starts = np.concatenate(([0], bounds + 1))[:-1]
+    keep = bounds - starts > win
+    return starts[keep], bounds[keep]
+
+
+@profiling.timed('split')
+def split_events(time, win, acqtimeus):
+    """Split the isolated samples into events.
+
+    Returns the (starts, ends) arrays of the events, as half-open ranges into
+    the isolated arrays. As in the original sample loop, the first isolated
+    sample is never part of an event, the sample following a gap opens the
+    next event without being part of it, runs not longer than win are
+    dropped and the trailing run, which no gap closes, is discarded.
+    """
+    time = np.asarray(time, dtype=float)
+    if len(time) < 2:
+        empty = np.empty(0, dtype=np.intp)
+        return empty, empty
+    bounds = np.flatnonzero(gaps(time[1:], 0, acqtimeus))
+    starts, ends = runs(bounds, win)
+    return starts + 1, ends + 1
+
+
+def event_profile(values, starts, ends, win):
+    """smooth(values[s:e], win) of every event, computed without a loop.
+
+    The interior of each event is the centred moving average of the event
+    samples; the first and last win//2 points come from the straight line
+    fitted to the first and last win samples, as in mode='interp'. Returns
+    an array the length of values, undefined outside the events.
+    """
+    half = win // 2
+    profile = np.full(len(values), np.nan)
+    profile[half:len(values) - half] = window_means(values, win)
+    if len(starts):
+        steps = np.arange(1, half + 1)
+        first = np.asarray(starts) + half
+        last = np.asarray(ends) - 1 - half
+        profile[first[:, None] - steps[::-1]] = edge_lines(values, first, win, True)
+        profile[last[:, None] + steps] = edge_lines(values, last, win, False)
+    return profile
+
+
+@profiling.timed('features')
+def event_features(time, fluo, pmt, starts, ends, win, features=FEATURES):
+    """Table of the features of every event, one column per name in features.
+
+    duration is the time from the first to the last sample and intensity the
+    maximum of the smoothed fluorescence. area integrates the raw
+    fluorescence over time; fwhm is the time from the first to the last
+    sample at half the smoothed peak or more, measured from the smoothed
+    minimum of the event, and rise and fall the times from 10% to 90% of
+    that height and back. pmt is the
+    smoothed maximum of the PMT signal, ratio that of fluo to PMT peaks.
+    All of them are computed at once over the concatenated event samples,
+    with reductions at the event offsets. pmt may be None if not needed.
+    """
+    time = np.asarray(time, dtype=float)
+    starts = np.asarray(starts, dtype=np.intp)
+    ends = np.asarray(ends, dtype=np.intp)
+    table = np.empty((len(starts), len(features)))
+    if len(starts) == 0:
+        return table
+    lengths = ends - starts
+    offsets = np.cumsum(lengths) - lengths
+    total = offsets[-1] + lengths[-1]
+    index = np.repeat(starts - offsets, lengths) + np.arange(total)
+    events = np.repeat(np.arange(len(starts)), lengths)
+    position = np.arange(total)
+    t = time[index]
+    computed = {}
+
+    def feature(name):
+        if name not in computed:
+            computed[name] = compute(name)
+        return computed[name]
+
+    def first(mask):
+        return np.minimum.reduceat(np.where(mask, position, total), offsets)
+
+    def last(mask):
+        return np.maximum.reduceat(np.where(mask, position, -1), offsets)
+
+    def above(fraction):
+        low = feature('low')
+        return feature('profile') >= (low + fraction * (feature('intensity') - low))[events]
+
+    def compute(name):
+        if name == 'duration':
+            return time[ends - 1] - time[starts]
+        if name == 'profile':
+            return event_profile(fluo, starts, ends, win)[index]
+        if name == 'intensity':
+            return np.maximum.reduceat(feature('profile'), offsets)
+        if name == 'low':
+            return np.minimum.reduceat(feature('profile'), offsets)
+        if name == 'area':
+            f = np.asarray(fluo, dtype=float)[index]
+            trapezoids = np.zeros(total)
+            trapezoids[:-1] = (f[1:] + f[:-1]) / 2 * np.diff(t)
+            cuts = np.column_stack((offsets, offsets + lengths - 1)).ravel()
+            return np.add.reduceat(trapezoids, cuts)[::2]
+        if name == 'fwhm':
+            half = above(0.5)
+            return t[last(half)] - t[first(half)]
+        if name == 'rise':
+            return t[first(above(0.9))] - t[first(above(0.1))]
+        if name == 'fall':
+            return t[last(above(0.1))] - t[last(above(0.9))]
+        if name == 'pmt':
+            return np.maximum.reduceat(event_profile(pmt, starts, ends, win)[index], offsets)
+        if name == 'ratio':
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return feature('intensity') / feature('pmt')
+        raise ValueError(f'unknown feature {name}')
+
+    for k, name in enumerate(features):
+        table[:, k] = feature(name)
+    return table
+
+
+def sweep(ranked, time, fluo, thresholds, win, acqtimeus, progress=None):
+    """Event count, mean duration and mean intensity for many thresholds.
+
+    ranked is the RankedSignal of the smoothed trace, computed once for all
+    thresholds; each of them then only touches the samples above it. The
+    means are NaN where no event is found. progress, if given, is called
+    with the number of thresholds done and their total.
+    """
+    thresholds = np.asarray(thresholds)
+    count = np.zeros(len(thresholds), dtype=int)
+    duration = np.full(len(thresholds), np.nan)
+    intensity = np.full(len(thresholds), np.nan)
+    for k, threshold in enumerate(thresholds):
+        if progress is not None:
+            progress(k, len(thresholds))
+        block = ranked.above(threshold)
+        isolated = time[block]
+        starts, ends = split_events(isolated, win, acqtimeus)
+        count[k] = len(starts)
+        if len(starts):
+            features = event_features(isolated, fluo[block], None, starts, ends, win,
+                                      ('duration', 'intensity'))
+            duration[k], intensity[k] = features.mean(axis=0)
+    return count, duration, intensity
+
+
+class EventSamples:
+    """The [time, fluo] array of every event, read only when accessed.
+
+    Events are held as (start, end) row ranges into the columns, which may
+    be memory-mapped, so that nothing is read up front whatever the number
+    of events. The last cache events read are kept, and reading one also
+    reads its prefetch neighbours on each side in a background thread,
+    ahead of a slider moving through them.
+    """
+
+    def __init__(self, time, fluo, starts, ends, cache=64, prefetch=2):
+        self.time = time
+        self.fluo = fluo
+        self.starts = np.asarray(starts, dtype=np.intp)
+        self.ends = np.asarray(ends, dtype=np.intp)
+        self.cache = cache
+        self.prefetch = prefetch
+        self.entries = OrderedDict()
+        self.pool = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    def read(self, k):
+        rows = slice(self.starts[k], self.ends[k])
+        return np.column_stack((self.time[rows], self.fluo[rows]))
+
+    def __getitem__(self, k):
+        if not -len(self) <= k < len(self):
+            raise IndexError(f'event {k} out of {len(self)}')
+        k = int(k) % len(self)
+        if k in self.entries:
+            self.entries.move_to_end(k)
+        else:
+            self.entries[k] = Future()
+            self.entries[k].set_result(self.read(k))
+        entry = self.entries[k]
+        for j in range(k - self.prefetch, k + self.prefetch + 1):
+            if 0 <= j < len(self) and j not in self.entries:
+                if self.pool is None:
+                    self.pool = ThreadPoolExecutor(1)
+                self.entries[j] = self.pool.submit(self.read, j)
+                self.entries.move_to_end(k)
+        while len(self.entries) > max(self.cache, 2 * self.prefetch + 1):
+            self.entries.popitem(last=False)
+        return entry.result()
+
+
+def event_samples(time, fluo, starts, ends, cache=64, prefetch=2):
+    """[time, fluo] arrays of every event, as an EventSamples sequence."""
+    return EventSamples(time, fluo, starts, ends, cache, prefetch)
+
+
+def ragged_samples(columns, starts, ends):
+    """The rows [s, e) of the columns for every event, as (values, offsets).
+
+    values holds the rows of all the events one after the other, with one
+    column per input column; event k is values[offsets[k]:offsets[k+1]].
+    """
+    starts = np.asarray(starts, dtype=np.intp)
+    lengths = np.asarray(ends, dtype=np.intp) - starts
+    offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    index = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+    values = np.empty((offsets[-1], len(columns)))
+    for k, column in enumerate(columns):
+        values[:, k] = np.asarray(column)[index]
+    return values, offsets
+
+
+def join_ragged(parts, width=3):
+    """Concatenate (values, offsets) pairs in order."""
+    parts = list(parts)
+    values = np.concatenate([values for values, offsets in parts]) if parts else np.empty((0, width))
+    offsets = np.zeros(1 + sum(len(offsets) - 1 for values, offsets in parts), dtype=np.int64)
+    if parts:
+        np.cumsum(np.concatenate([np.diff(offsets) for values, offsets in parts]), out=offsets[1:])
+    return values, offsets
+
+
+def find_events(time, fluo, threshold, win, acqtimeus, filtered=None):
+    """Isolate and split a whole trace.
+
+    Returns the indices of the isolated samples and the (starts, ends) of the
+    events within them.
+    """
+    if filtered is None:
+        filtered = smooth(fluo, win)
+    block = isolate(filtered, threshold)
+    starts, ends = split_events(np.asarray(time)[block], win, acqtimeus)
+    return block, starts, ends
+
+
+def smooth_chunks(chunks, win):
+    """Smooth a trace read as consecutive (time, fluo, pmt) chunks.
+
+    Yields (time, fluo, pmt, filtered) for the samples whose smoothed value
+    is final, as given by a MovingAverage of the fluo column; the samples
+    waiting for theirs are carried over to the next chunk. The result is
+    bit for bit that of smooth() on the whole fluo column.
+    """
+    smoother = MovingAverage(win)
+    pending = None
+    for columns in chunks:
+        columns = [np.asarray(column, dtype=float) for column in columns]
+        filtered = smoother.feed(columns[1])
+        if pending is not None:
+            columns = [np.concatenate((p, c)) for p, c in zip(pending, columns)]
+        pending = [column[len(filtered):] for column in columns]
+        if len(filtered):
+            yield tuple(column[:len(filtered)] for column in columns) + (filtered,)
+    if pending is None:
+        return
+    yield tuple(pending) + (smoother.close(),)
+
+
+class EventStream:
+    """Incremental counterpart of find_events() and event_features().
+
+    Fed the smoothed chunks in order, returns the feature table of the
+    events closed by each of them; the isolated (time, fluo, pmt) samples of
+    the event still open are carried over to the next chunk. With keep, the
+    samples of the closed events are collected in kept as ragged_samples().
+    """
+
+    def __init__(self, threshold, win, acqtimeus, features=FEATURES, keep=False):
+        self.threshold = threshold
+        self.win = win
+        self.acqtimeus = acqtimeus
+        self.features = features
+        self.keep = keep
+        self.kept = []
+        self.prevtime = None
+        self.open = (np.empty(0), np.empty(0), np.empty(0))
+        self.samples = 0
+        self.isolated = 0
+        self.count = 0
+
+    def feed(self, time, fluo, pmt, filtered):
+        self.samples += len(time)
+        block = isolate(filtered, self.threshold)
+        self.isolated += len(block)
+        return self.feed_isolated(time[block], fluo[block], pmt[block])
+
+    def feed_isolated(self, time, fluo, pmt):
+        empty = np.empty((0, len(self.features)))
+        if self.prevtime is None:
+            if len(time) == 0:
+                return empty
+            self.prevtime = 0
+            time, fluo, pmt = time[1:], fluo[1:], pmt[1:]
+        if len(time) == 0:
+            return empty
+        with profiling.stage('split'):
+            bounds = np.flatnonzero(gaps(time, self.prevtime, self.acqtimeus))
+            self.prevtime = time[-1]
+            opened = len(self.open[0])
+            columns = [np.concatenate((o, c)) for o, c in zip(self.open, (time, fluo, pmt))]
+            if len(bounds):
+                rest = opened + bounds[-1] + 1
+                self.open = tuple(column[rest:] for column in columns)
+            else:
+                self.open = tuple(columns)
+            starts, ends = runs(bounds + opened, self.win)
+        self.count += len(starts)
+        if self.keep:
+            self.kept.append(ragged_samples(columns, starts, ends))
+        return event_features(*columns, starts, ends, self.win, self.features)
+
+    def join(self, samples, segment):
+        """Append a segment summarised by segment_events(), in trace order."""
+        isolated, head, events, tail, last, kept = segment
+        self.samples += samples
+        self.isolated += isolated
+        features = self.feed_isolated(*head)
+        if tail is None:
+            return features
+        self.count += len(events)
+        if self.keep:
+            self.kept.append(kept)
+        self.open = tail
+        self.prevtime = last
+        return np.concatenate((features, events))
+
+
+@profiling.timed('split')
+def segment_events(time, fluo, pmt, filtered, threshold, win, acqtimeus, features=FEATURES, keep=False):
+    """Summarise one segment of a trace split for parallel processing.
+
+    Events entirely inside the segment are measured here; what precedes the
+    first gap (head) and follows the last one (tail) is returned as isolated
+    samples, for EventStream.join() to stitch to the neighbouring segments.
+    With keep, the samples of the events inside are returned as well.
+    """
+    block = isolate(filtered, threshold)
+    columns = time[block], fluo[block], pmt[block]
+    time = columns[0]
+    bounds = np.flatnonzero(gaps(time[1:], time[0], acqtimeus)) + 1 if len(time) > 1 else []
+    if len(bounds) == 0:
+        return len(block), columns, None, None, None, None
+    first = bounds[0] + 1
+    starts, ends = runs(bounds[1:] - first, win)
+    inside = [column[first:] for column in columns]
+    events = event_features(*inside, starts, ends, win, features)
+    kept = ragged_samples(inside, starts, ends) if keep else None
+    rest = bounds[-1] + 1
+    head = tuple(column[:first] for column in columns)
+    tail = tuple(column[rest:] for column in columns)
+    return len(block), head, events, tail, time[-1], kept
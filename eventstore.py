@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+
+# Columnar storage of the event tables and of the samples of every event.
+# The table has one column per feature and is written in one go as NPZ,
+# Parquet or Feather (the last two need pandas with pyarrow); the samples
+# are a ragged array stored next to it in <name>_samples.npz: the
+# concatenated rows of all the events plus the offsets where each starts.
+
+FORMATS = ('npz', 'parquet', 'feather')
+SAMPLES = ('time', 'fluo', 'pmt')
+# Column headers of the CSV tables written by batch.py
+HEADERS = {'duration': 'Duration [ms]', 'intensity': 'Intensity []a.u]', 'area': 'Area [a.u.*ms]',
+           'fwhm': 'FWHM [ms]', 'rise': 'Rise time [ms]', 'fall': 'Fall time [ms]',
+           'pmt': 'PMT [a.u.]', 'ratio': 'Fluo/PMT []'}
+# Features in time units, which zoomer.py saves multiplied by SCALE
+SCALED = ('duration', 'area', 'fwhm', 'rise', 'fall')
+SCALE = 1000
+
+
+def table_format(path):
+    """The columnar format of path from its extension, None for text files."""
+    extension = os.path.splitext(path)[1].lstrip('.').lower()
+    return extension if extension in FORMATS else None
+
+
+def samples_path(path):
+    return os.path.splitext(path)[0] + '_samples.npz'
+
+
+def save_table(path, table, names):
+    """Write the (events, features) table in the format given by the extension of path."""
+    table = np.asarray(table, dtype=float)
+    save_columns(path, {name: table[:, k] for k, name in enumerate(names)})
+
+
+def save_columns(path, columns):
+    """Write a table given as {name: column}, whose columns may be of any type, like save_table()."""
+    format = table_format(path)
+    if format == 'npz':
+        np.savez(path, names=np.array(list(columns)), **columns)
+    elif format in ('parquet', 'feather'):
+        import pandas as pd
+        frame = pd.DataFrame(columns)
+        if format == 'parquet':
+            frame.to_parquet(path, index=False)
+        else:
+            frame.to_feather(path)
+    else:
+        raise ValueError(f'{path}: not a {", ".join(FORMATS)} file')
+
+
+def save_samples(path, values, offsets, names=SAMPLES):
+    np.savez(path, values=values, offsets=offsets, names=np.array(names))
+
+
+def load_table(path):
+    """The event table at path as a pandas DataFrame, whatever its format."""
+    import pandas as pd
+    format = table_format(path)
+    if format == 'npz':
+        with np.load(path) as data:
+            return pd.DataFrame({str(name): data[str(name)] for name in data['names']})
+    if format == 'parquet':
+        return pd.read_parquet(path)
+    if format == 'feather':
+        return pd.read_feather(path)
+    return pd.read_csv(path)
+
+
+def load_samples(path):
+    """(values, offsets, names) of a ragged samples file; event k is values[offsets[k]:offsets[k+1]]."""
+    with np.load(path) as data:
+        return data['values'], data['offsets'], [str(name) for name in data['names']]
@@ -0,0 +1,189 @@
+import atexit
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Opt-in timing and counters for the analysis pipeline. Stages nest: each
+# one records its calls, its total time, its own time (total minus that of
+# the stages run inside it) and, when allocations are traced, the peak of
+# memory allocated above what was in use when it started. Everything is a
+# no-op until enable() is called, or ZMICRO_PROFILE names the JSON file to
+# write the report to at exit. Reports also carry the peak resident memory
+# of the process so far, where the platform tells it.
+
+log = logging.getLogger('zmicro.profile')
+
+
+def peak_memory():
+    """Peak resident memory of the process in bytes, or None where unknown."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Profile:
+    def __init__(self):
+        self.enabled = False
+        self.allocations = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+            self.counters = {}
+            self.peak = None
+            self.started = time.perf_counter()
+
+    def enable(self, allocations=False):
+        self.enabled = True
+        self.allocations = allocations
+        if allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def disable(self):
+        self.enabled = False
+        if self.allocations and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.allocations = False
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        stack = self.local.__dict__.setdefault('stack', [])
+        frame = {'children': 0.0, 'peak': 0}
+        if self.allocations:
+            frame['memory'] = tracemalloc.get_traced_memory()[0]
+            frame['peak'] = frame['memory']
+            tracemalloc.reset_peak()
+        stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            peak = 0
+            if self.allocations:
+                frame['peak'] = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                peak = frame['peak'] - frame['memory']
+            if stack:
+                stack[-1]['children'] += seconds
+                stack[-1]['peak'] = max(stack[-1]['peak'], frame['peak'])
+            with self.lock:
+                entry = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'self': 0.0, 'peak_bytes': 0})
+                entry['calls'] += 1
+                entry['seconds'] += seconds
+                entry['self'] += seconds - frame['children']
+                entry['peak_bytes'] = max(entry['peak_bytes'], peak)
+            log.debug('%s: %.6fs', name, seconds)
+
+    def timed(self, name=None):
+        """Decorator running the function as a stage, named after it by default."""
+        def decorator(function):
+            stagename = name or function.__name__
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with self.stage(stagename):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add(self, report):
+        """Fold in the stages, counters and peak memory of a report, e.g. from a worker process."""
+        with self.lock:
+            total = merge([{'elapsed': 0.0, 'peak_memory': self.peak, 'stages': self.stages,
+                            'counters': self.counters}, report])
+            self.stages, self.counters, self.peak = total['stages'], total['counters'], total['peak_memory']
+
+    def report(self):
+        with self.lock:
+            peak = peak_memory()
+            if self.peak is not None:
+                peak = max(peak or 0, self.peak)
+            return {'elapsed': time.perf_counter() - self.started, 'peak_memory': peak,
+                    'stages': {name: dict(entry) for name, entry in self.stages.items()},
+                    'counters': dict(self.counters)}
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+
+
+profile = Profile()
+stage = profile.stage
+timed = profile.timed
+count = profile.count
+report = profile.report
+add = profile.add
+
+
+def enabled():
+    return profile.enabled
+
+
+def enable(allocations=False, path=None):
+    """Start profiling; with a path, the JSON report is written there at exit."""
+    profile.enable(allocations)
+    if path:
+        atexit.register(profile.write, path)
+
+
+def disable():
+    profile.disable()
+
+
+def merge(reports):
+    """Sum the stages and counters of several reports, e.g. from worker processes."""
+    total = {'elapsed': 0.0, 'peak_memory': None, 'stages': {}, 'counters': {}}
+    for report in reports:
+        total['elapsed'] = max(total['elapsed'], report['elapsed'])
+        if report.get('peak_memory') is not None:
+            total['peak_memory'] = max(total['peak_memory'] or 0, report['peak_memory'])
+        for name, entry in report['stages'].items():
+            into = total['stages'].setdefault(name, {'calls': 0, 'seconds': 0.0, 'self': 0.0, 'peak_bytes': 0})
+            for key in ('calls', 'seconds', 'self'):
+                into[key] += entry[key]
+            into['peak_bytes'] = max(into['peak_bytes'], entry['peak_bytes'])
+        for name, value in report['counters'].items():
+            total['counters'][name] = total['counters'].get(name, 0) + value
+    return total
+
+
+def summary(report=None):
+    """A few lines of text with the stages sorted by their own time."""
+    report = report or profile.report()
+    lines = []
+    for name, entry in sorted(report['stages'].items(), key=lambda item: -item[1]['self']):
+        line = f'{name}: {entry["calls"]}x {entry["self"]*1000:.1f}ms'
+        if entry['peak_bytes']:
+            line += f' +{entry["peak_bytes"]/2**20:.1f}MB'
+        lines.append(line)
+    lines += [f'{name}: {value}' for name, value in report['counters'].items()]
+    if report.get('peak_memory') is not None:
+        lines.append(f'peak memory: {report["peak_memory"]/2**20:.0f}MB')
+    return '\n'.join(lines)
+
+
+if os.environ.get('ZMICRO_PROFILE'):
+    enable(os.environ.get('ZMICRO_PROFILE_ALLOCATIONS') == '1', os.environ['ZMICRO_PROFILE'])
@@ -0,0 +1,100 @@
+import numpy as np
+
+import engine
+import tracefile
+
+# Decimation of the curves drawn by zoomer.py for the current view. Only
+# the points inside the visible x range are touched: each pixel column is
+# drawn as the min and max of the points falling in it, so that no peak is
+# lost at any zoom, and the smoothed fit is computed for the visible points
+# alone. Views spanning many buckets per pixel column are drawn from an
+# in-memory pyramid of (min, max, sum) buckets instead, as the trace cache
+# does, so that the cost of a frame depends on the pixels and not on the
+# points. Symbols are only drawn when the points are SPACING pixels apart
+# or more, beyond that they would merge into the line anyway.
+
+SPACING = 4
+
+
+def pyramid(y):
+    """(size, buckets) levels of y from tracefile.BUCKET rows per bucket up to about tracefile.TOP buckets."""
+    levels = []
+    size = tracefile.BUCKET
+    data = tracefile.reduce_buckets(y, y, y, size)
+    while len(y):
+        levels.append((size, data))
+        if len(data) <= tracefile.TOP:
+            break
+        data = tracefile.reduce_buckets(data[:, 0], data[:, 1], data[:, 2], tracefile.FACTOR)
+        size *= tracefile.FACTOR
+    return levels
+
+
+def visible(x, lo, hi, context=0):
+    """Bounds [a, b) of the sorted x within [lo, hi], widened by context points on each side."""
+    a = int(np.searchsorted(x, lo, side='left'))
+    b = int(np.searchsorted(x, hi, side='right'))
+    return max(a - context, 0), min(b + context, len(x))
+
+
+def columns(x, low, high, lo, hi, pixels):
+    """(x, y) of the min of low and the max of high in each of pixels columns between lo and hi.
+
+    Spans with fewer than two points per column are returned as they are.
+    """
+    if len(x) <= 2 * pixels or hi <= lo:
+        return x, low
+    # x is sorted: the columns start where a binary search puts their edges
+    edges = np.searchsorted(x, lo + (hi - lo) / pixels * np.arange(1, pixels))
+    starts = np.unique(np.concatenate(([0], edges[edges < len(x)])))
+    low = np.minimum.reduceat(low, starts)
+    high = np.maximum.reduceat(high, starts)
+    return np.repeat(x[starts], 2), np.column_stack((low, high)).ravel()
+
+
+def level(levels, count, pixels):
+    """The coarsest of levels with two buckets per pixel column or more over count points, if any."""
+    usable = [(size, data) for size, data in levels if count // size >= 2 * pixels]
+    return usable[-1] if usable else None
+
+
+def from_level(x, a, b, lo, hi, pixels, found):
+    size, data = found
+    first, last = a // size, -(-b // size)
+    data = data[first:last]
+    return columns(x[first * size:last * size:size], data[:, 0], data[:, 1], lo, hi, pixels)
+
+
+def decimate(x, y, lo, hi, pixels, levels=()):
+    """The visible part of the curve (x, y), decimated to pixels columns; also returns the visible count."""
+    # One point beyond each side keeps the line running to the view edges
+    a, b = visible(x, lo, hi, 1)
+    found = level(levels, b - a, pixels)
+    if found:
+        return from_level(x, a, b, lo, hi, pixels, found) + (b - a,)
+    return columns(x[a:b], y[a:b], y[a:b], lo, hi, pixels) + (b - a,)
+
+
+def fit(x, y, lo, hi, win, pixels, levels=()):
+    """The smoothed curve of the visible part of (x, y), decimated to pixels columns.
+
+    win//2 points of context on each side make the visible values those of
+    smoothing the whole curve; levels, if given, are the pyramid of that
+    whole smoothed curve, used for the views too wide to smooth per frame.
+    """
+    half = win // 2
+    a, b = visible(x, lo, hi, 1)
+    found = level(levels, b - a, pixels)
+    if found:
+        return from_level(x, a, b, lo, hi, pixels, found)
+    s, e = max(a - half, 0), min(b + half, len(x))
+    values = y[s:e]
+    if len(values) >= win:
+        values = engine.smooth_segment(values, win, s == 0, e == len(x))
+    values = values[a - s:b - s]
+    return columns(x[a:b], values, values, lo, hi, pixels)
+
+
+def symbol(count, pixels, shape='o'):
+    """The symbol to draw count points across pixels with, None when too dense."""
+    return shape if count * SPACING <= pixels else None
@@ -0,0 +1,54 @@
+import argparse
+import os
+import sys
+import time
+
+# Stand-in for the instrument: copies a trace to a new file at the pace it
+# was acquired, in timed blocks of lines, so that the follow modes of
+# batch.py and zoomer.py can be tried on a file that is still growing.
+
+
+def replay(source, target, rate=400000, interval=0.1, speed=1.0, limit=None):
+    """Append the lines of source to target, rate lines per second of trace.
+
+    Every interval seconds the lines due by then are written and flushed;
+    speed scales the pace and limit stops after that many data lines.
+    """
+    per_block = max(1, int(rate * interval * speed))
+    written = 0
+    with open(source, 'rb') as src, open(target, 'wb') as out:
+        out.write(src.readline())
+        out.flush()
+        start = time.monotonic()
+        while limit is None or written < limit:
+            count = per_block if limit is None else min(per_block, limit - written)
+            lines = [line for line in (src.readline() for _ in range(count)) if line]
+            if not lines:
+                break
+            out.writelines(lines)
+            out.flush()
+            written += len(lines)
+            delay = start + written / (rate * speed) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write a copy of a trace at its acquisition pace.')
+    parser.add_argument('source')
+    parser.add_argument('target')
+    parser.add_argument('--rate', type=float, default=400000, help='lines per second of trace')
+    parser.add_argument('--interval', type=float, default=0.1, help='seconds between writes')
+    parser.add_argument('--speed', type=float, default=1.0, help='pace relative to the acquisition')
+    parser.add_argument('-n', '--lines', type=int, help='stop after this many data lines')
+    args = parser.parse_args(argv)
+    if os.path.abspath(args.source) == os.path.abspath(args.target):
+        parser.error('source and target must differ')
+    start = time.monotonic()
+    written = replay(args.source, args.target, args.rate, args.interval, args.speed, args.lines)
+    print(f'{written} lines written in {time.monotonic()-start:.1f}s')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
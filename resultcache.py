@@ -0,0 +1,183 @@
+import argparse
+import functools
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import engine
+
+# Persistent cache of the event tables of whole runs, so that analysing an
+# unchanged trace again with unchanged settings returns at once. An entry is
+# keyed by a fingerprint of the trace (its size, its modification time and a
+# hash of SAMPLES blocks spread over it, so that huge traces are not read
+# whole), the parameters of the run, the acquisition step the events were
+# split with and a hash of the code computing them; it holds the table and
+# the parameters and total time of the run that computed it.
+# Entries are single .npz files, written atomically, whose modification time
+# is their last use: the least recently used are dropped beyond LIMIT bytes.
+
+DIRECTORY = os.environ.get('ZMICRO_RESULTS') or os.path.join(os.path.expanduser('~'), '.cache', 'zmicro', 'results')
+LIMIT = 1 << 30
+SAMPLES = 16
+BLOCK = 1 << 16
+CODE = ('engine.py', 'tracefile.py', 'batch.py', 'zoomer.py')
+
+
+def fingerprint(filename):
+    """(size, mtime, sampled hash) of a file, the hash covering SAMPLES blocks of BLOCK bytes."""
+    st = os.stat(filename)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filename, 'rb') as f:
+        if st.st_size <= SAMPLES * BLOCK:
+            digest.update(f.read())
+        else:
+            for offset in np.linspace(0, st.st_size - BLOCK, SAMPLES).astype(int).tolist():
+                f.seek(offset)
+                digest.update(f.read(BLOCK))
+    return {'size': st.st_size, 'mtime': st.st_mtime_ns, 'sample': digest.hexdigest()}
+
+
+@functools.lru_cache()
+def code_version():
+    """Hash of the sources of the modules computing the events."""
+    digest = hashlib.blake2b(digest_size=8)
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in CODE:
+        with open(os.path.join(here, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def run_key(filename, threshold, win, acqtimeus, features=engine.FEATURES, uniform=False):
+    """Cache key of the events of a trace for a run with the given parameters."""
+    key = {'trace': fingerprint(filename), 'threshold': threshold, 'window': win, 'acqtimeus': acqtimeus,
+           'features': list(features), 'uniform': uniform, 'code': code_version()}
+    return hashlib.blake2b(json.dumps(key, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
+class ResultCache:
+    """Directory of cached event tables, bounded to limit bytes."""
+
+    def __init__(self, directory=None, limit=LIMIT):
+        self.directory = directory or DIRECTORY
+        self.limit = limit
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        """(table, meta) of the entry, or None; a hit makes it the most recently used."""
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                table, meta = data['table'], json.loads(str(data['meta']))
+        except (OSError, KeyError, ValueError):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return table, meta
+
+    def put(self, key, table, meta):
+        """Store the table of a run, with meta describing it, then evict down to the limit."""
+        os.makedirs(self.directory, exist_ok=True)
+        meta = dict(meta, created=time.time())
+        fd, temp = tempfile.mkstemp(suffix='.npz', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, table=np.asarray(table, dtype=float), meta=np.array(json.dumps(meta)))
+            os.replace(temp, self.path(key))
+        except BaseException:
+            os.unlink(temp)
+            raise
+        self.evict()
+
+    def entries(self):
+        """(key, size, last used, path) of every entry, the least recently used first."""
+        try:
+            names = [name for name in os.listdir(self.directory) if name.endswith('.npz') and not name.startswith('tmp')]
+        except FileNotFoundError:
+            return []
+        found = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            found.append((name[:-4], st.st_size, st.st_mtime, path))
+        return sorted(found, key=lambda entry: entry[2])
+
+    def remove(self, keys):
+        removed = 0
+        for key in keys:
+            try:
+                os.unlink(self.path(key))
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def evict(self, limit=None):
+        """Drop the least recently used entries until they take limit bytes at most; returns their count."""
+        limit = self.limit if limit is None else limit
+        entries = self.entries()
+        total = sum(size for key, size, used, path in entries)
+        drop = []
+        for key, size, used, path in entries:
+            if total <= limit:
+                break
+            drop.append(key)
+            total -= size
+        return self.remove(drop)
+
+    def meta(self, key):
+        with np.load(self.path(key)) as data:
+            return json.loads(str(data['meta']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inspect or purge the cache of the event tables of past runs.')
+    parser.add_argument('--dir', help=f'cache directory (default: $ZMICRO_RESULTS or {DIRECTORY})')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help='list the entries, the least recently used first')
+    showing = commands.add_parser('show', help='print the parameters and run time of an entry')
+    showing.add_argument('key')
+    purging = commands.add_parser('purge', help='remove entries, all of them by default')
+    purging.add_argument('--source', help='only those of this trace')
+    purging.add_argument('--older', type=float, metavar='DAYS', help='only those unused for this many days')
+    purging.add_argument('--size', type=float, metavar='MB', help='only the least recently used beyond this size')
+    args = parser.parse_args(argv)
+
+    cache = ResultCache(args.dir)
+    if args.command == 'list':
+        entries = cache.entries()
+        for key, size, used, path in entries:
+            meta = cache.meta(key)
+            print(f'{key},{time.strftime("%Y-%m-%d %H:%M", time.localtime(used))},{size},{meta.get("source")},'
+                  f'{meta.get("threshold")},{meta.get("window")},{meta.get("events")},{meta.get("elapsed", 0):.1f}s')
+        print(f'{len(entries)} entries, {sum(e[1] for e in entries)/1e6:.1f}MB in {cache.directory}')
+    elif args.command == 'show':
+        try:
+            print(json.dumps(cache.meta(args.key), indent=1))
+        except FileNotFoundError:
+            parser.error(f'no entry {args.key}')
+    elif args.size is not None:
+        print(f'{cache.evict(int(args.size * 1e6))} entries removed')
+    else:
+        keys = [key for key, size, used, path in cache.entries()
+                if args.older is None or used < time.time() - args.older * 86400]
+        if args.source:
+            source = os.path.abspath(args.source)
+            keys = [key for key in keys if cache.meta(key).get('source') == source]
+        print(f'{cache.remove(keys)} entries removed')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+import numpy as np
+
+# Selection of events by their position in a scatter of two features. The
+# points are binned once into a uniform grid of about PER_CELL points per
+# cell, stored as the event ids sorted by cell plus the offset where each
+# cell starts; a row of cells is then a single slice of the ids, so a
+# rectangle only reads the rows it spans and tests the points of those.
+# Lassos are tested within their bounding rectangle.
+
+PER_CELL = 4
+MAX_SIDE = 1024
+
+
+def inside_polygon(x, y, px, py):
+    """Mask of the points (x, y) inside the polygon (px, py), by the even-odd rule."""
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    inside = np.zeros(len(x), dtype=bool)
+    px, py = np.asarray(px, dtype=float), np.asarray(py, dtype=float)
+    # Each edge only concerns the points within its span of y, a slice of
+    # the points sorted by y
+    order = np.argsort(y)
+    sorted_y = y[order]
+    for x0, y0, x1, y1 in zip(px, py, np.roll(px, -1), np.roll(py, -1)):
+        if y0 == y1:
+            continue
+        band = order[np.searchsorted(sorted_y, min(y0, y1)):np.searchsorted(sorted_y, max(y0, y1))]
+        at = x0 + (y[band] - y0) * (x1 - x0) / (y1 - y0)
+        inside[band] ^= x[band] < at
+    return inside
+
+
+class EventIndex:
+    """Grid index of the (x, y) points of n events, whose ids are 0..n-1.
+
+    Points with a NaN coordinate are never selected.
+    """
+
+    def __init__(self, x, y):
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        valid = np.flatnonzero(np.isfinite(self.x) & np.isfinite(self.y))
+        self.side = int(min(max(np.sqrt(len(valid) / PER_CELL), 1), MAX_SIDE))
+        if len(valid):
+            self.lo = np.array([self.x[valid].min(), self.y[valid].min()])
+            span = np.array([self.x[valid].max(), self.y[valid].max()]) - self.lo
+        else:
+            self.lo, span = np.zeros(2), np.ones(2)
+        self.scale = self.side / np.where(span > 0, span, 1)
+        cell = self.row(self.y[valid], 1) * self.side + self.row(self.x[valid], 0)
+        order = np.argsort(cell, kind='stable')
+        self.ids = valid[order]
+        self.starts = np.searchsorted(cell[order], np.arange(self.side * self.side + 1))
+
+    def __len__(self):
+        return len(self.x)
+
+    def row(self, values, axis):
+        """Grid row (axis 1) or column (axis 0) of the values."""
+        return np.clip(((np.asarray(values) - self.lo[axis]) * self.scale[axis]).astype(np.intp), 0, self.side - 1)
+
+    def rect(self, x0, x1, y0, y1):
+        """Sorted ids of the events with x0 <= x <= x1 and y0 <= y <= y1."""
+        x0, x1 = sorted((x0, x1))
+        y0, y1 = sorted((y0, y1))
+        if len(self.ids) == 0:
+            return np.empty(0, dtype=np.intp)
+        c0, c1 = self.row(x0, 0), self.row(x1, 0)
+        rows = np.arange(self.row(y0, 1), self.row(y1, 1) + 1)
+        ids = np.concatenate([self.ids[self.starts[r * self.side + c0]:self.starts[r * self.side + c1 + 1]]
+                              for r in rows])
+        x, y = self.x[ids], self.y[ids]
+        return np.sort(ids[(x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)])
+
+    def lasso(self, px, py):
+        """Sorted ids of the events inside the polygon (px, py)."""
+        if len(px) < 3:
+            return np.empty(0, dtype=np.intp)
+        ids = self.rect(np.min(px), np.max(px), np.min(py), np.max(py))
+        return ids[inside_polygon(self.x[ids], self.y[ids], px, py)]
+
+    def nearest(self, x, y, rx, ry):
+        """Id of the event nearest to (x, y) within the ellipse of radii (rx, ry), or None."""
+        ids = self.rect(x - rx, x + rx, y - ry, y + ry)
+        if len(ids) == 0:
+            return None
+        distance = ((self.x[ids] - x) / rx) ** 2 + ((self.y[ids] - y) / ry) ** 2
+        k = np.argmin(distance)
+        return int(ids[k]) if distance[k] <= 1 else None
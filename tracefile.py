@@ -0,0 +1,426 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+import profiling
+
+# Chunked reading of the Zeiss time,fluo,PMT CSV traces and the binary
+# sidecar cache built from them. The cache is a directory next to the CSV,
+# or under FALLBACK, keyed by the path of the CSV, where that is read-only,
+# holding meta.json plus one raw column file per channel, reopened with
+# np.memmap so that only the pages actually used are read from disk.
+# Any row is reached directly through the memory maps, and a row is found
+# from its time by bisection, or computed for uniform traces. Alongside the
+# columns, a pyramid of (min, max, sum) buckets of fluo and PMT lets any
+# range be drawn from about as many buckets as pixels. The sampling of every
+# trace is checked while the cache is built: when it is uniform, the time
+# column can be opened as computed from the row index instead, which reads
+# nothing from the stored one. fluo and PMT are stored as float32 unless
+# some value of theirs would not survive the conversion, which halves the
+# cache and the pages read from it.
+
+COLUMNS = ('time', 'fluo', 'pmt')
+FALLBACK = os.environ.get('ZMICRO_TRACES') or os.path.join(os.path.expanduser('~'), '.cache', 'zmicro', 'traces')
+CHUNK = 1 << 24
+VERSION = 7
+BUCKET = 64
+FACTOR = 8
+TOP = 1024
+GAPS = 100
+COMPACT = ('fluo', 'pmt')
+
+
+def read_chunks(filename, chunksize=CHUNK, progress=None):
+    """Yield (time, fluo, pmt) arrays for consecutive blocks of about chunksize bytes.
+
+    progress, if given, is called with the bytes read so far and the file size.
+    """
+    total = os.path.getsize(filename)
+    with open(filename) as f:
+        done = len(f.readline())
+        while True:
+            lines = f.readlines(chunksize)
+            if not lines:
+                return
+            if progress is not None:
+                done += sum(map(len, lines))
+                progress(done, total)
+            yield parse_lines(lines)
+
+
+def follow(filename, poll=0.2, idle=10.0, wait=None, blocksize=CHUNK):
+    """Yield (time, fluo, pmt) arrays for the lines appended to filename as it grows.
+
+    Only the new bytes are read and only complete lines are parsed. The
+    trace is taken as finished once it has not grown for idle seconds, or
+    never if idle is None; wait, if given, is called while waiting for data
+    and may raise to stop following.
+    """
+    with open(filename, 'rb') as f:
+        pending = b''
+        header = True
+        quiet = time.monotonic()
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                if idle is not None and time.monotonic() - quiet > idle:
+                    break
+                if wait is not None:
+                    wait()
+                time.sleep(poll)
+                continue
+            quiet = time.monotonic()
+            pending += block
+            cut = pending.rfind(b'\n') + 1
+            lines, pending = pending[:cut].decode().splitlines(), pending[cut:]
+            if header and lines:
+                lines, header = lines[1:], False
+            lines = [line for line in lines if line.strip()]
+            if lines:
+                yield parse_lines(lines)
+        if pending.strip() and not header:
+            yield parse_lines([pending.decode()])
+
+
+@profiling.timed('parse')
+def parse_lines(lines):
+    if not lines:
+        return np.empty(0), np.empty(0), np.empty(0)
+    if profiling.enabled():
+        profiling.count('bytes read', sum(map(len, lines)))
+    data = np.loadtxt(lines, delimiter=',', usecols=(0, 1, 2), ndmin=2)
+    return data[:, 0], data[:, 1], data[:, 2]
+
+
+def line_ranges(filename, size):
+    """Split the data lines of filename into byte ranges of about size bytes."""
+    with open(filename, 'rb') as f:
+        f.readline()
+        bounds = [f.tell()]
+        total = os.fstat(f.fileno()).st_size
+        while bounds[-1] + size < total:
+            f.seek(bounds[-1] + size - 1)
+            f.readline()
+            if f.tell() >= total:
+                break
+            bounds.append(f.tell())
+        bounds.append(total)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def read_range(filename, start, end, context):
+    """Parse the lines in the byte range [start, end) of filename.
+
+    Up to context lines before and after the range are parsed as well; returns
+    the (time, fluo, pmt) columns and the number of context rows on each side.
+    """
+    with open(filename, 'rb') as f:
+        f.readline()
+        first = f.tell()
+        before = []
+        back = start
+        size = 64 * (context + 1)
+        while back > first and len(before) < context:
+            back = max(first, start - size)
+            f.seek(back)
+            before = f.read(start - back).decode().splitlines()
+            if back > first:
+                before = before[1:]
+            size *= 2
+        before = [line for line in before if line.strip()][-context:] if context else []
+        f.seek(start)
+        lines = f.read(end - start).decode().splitlines()
+        after = [line for line in (f.readline().decode() for _ in range(context)) if line.strip()]
+    columns = [np.concatenate(c) for c in zip(parse_lines(before), parse_lines(lines), parse_lines(after))]
+    return columns, len(before), len(after)
+
+
+def cache_path(filename):
+    """<filename>.zmc, or its counterpart under FALLBACK when the directory of filename is read-only.
+
+    A current sidecar cache is used even in a read-only directory.
+    """
+    sidecar = filename + '.zmc'
+    if os.access(os.path.dirname(os.path.abspath(filename)), os.W_OK) or read_meta(sidecar, filename):
+        return sidecar
+    key = hashlib.blake2b(os.path.abspath(filename).encode(), digest_size=8).hexdigest()
+    return os.path.join(FALLBACK, f'{key}-{os.path.basename(filename)}.zmc')
+
+
+def source_stamp(filename):
+    st = os.stat(filename)
+    return {'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+
+class SamplingCheck:
+    """Streaming check that a time column is sampled at a constant step.
+
+    Fed the time chunks in order, it records the rows where the step
+    differs from that of the first two samples by more than half of it
+    (the first GAPS of them, and their count).
+    """
+
+    def __init__(self):
+        self.start = self.step = self.last = None
+        self.rows = 0
+        self.gaps = []
+        self.gapcount = 0
+
+    def feed(self, time):
+        if len(time) == 0:
+            return
+        if self.start is None:
+            self.start = float(time[0])
+            self.last = self.start
+        if self.step is None and self.rows + len(time) > 1:
+            self.step = float(time[1 - self.rows]) - self.start
+        steps = np.diff(time, prepend=self.last)
+        if self.rows == 0:
+            steps = steps[1:]
+        bad = np.flatnonzero(np.abs(steps - self.step) > abs(self.step) / 2)
+        self.gapcount += len(bad)
+        first = self.rows + (self.rows == 0)
+        self.gaps += [(int(first + k), float(steps[k])) for k in bad[:GAPS - len(self.gaps)]]
+        self.rows += len(time)
+        self.last = float(time[-1])
+
+    def model(self, time, tolerance=1e-3):
+        """(start, step) of the times of the written column time, or None if not uniform.
+
+        The step is taken from the first and last samples; every sample must
+        then lie within tolerance steps of start + row * step.
+        """
+        if self.gapcount or self.rows < 2:
+            return None
+        step = (self.last - self.start) / (self.rows - 1)
+        block = CHUNK
+        for a in range(0, self.rows, block):
+            expected = self.start + np.arange(a, min(a + block, self.rows)) * step
+            if np.max(np.abs(time[a:a + block] - expected)) > tolerance * abs(step):
+                return None
+        return self.start, step
+
+
+class UniformTime:
+    """The time column of a uniformly sampled trace, computed from the row index."""
+
+    dtype = np.dtype(np.float64)
+    ndim = 1
+
+    def __init__(self, start, step, rows):
+        self.start = start
+        self.step = step
+        self.rows = rows
+        self.shape = (rows,)
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.start + np.arange(*index.indices(self.rows)) * self.step
+        index = np.asarray(index)
+        if index.dtype == bool:
+            index = np.flatnonzero(index)
+        if index.size and (index.min() < -self.rows or index.max() >= self.rows):
+            raise IndexError(f'index out of bounds for {self.rows} rows')
+        return self.start + np.where(index < 0, index + self.rows, index) * self.step
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:] if dtype is None else self[:].astype(dtype)
+
+    def row_at(self, time):
+        rows = np.clip(np.ceil((np.asarray(time) - self.start) / self.step - 1e-9), 0, self.rows).astype(np.int64)
+        return int(rows) if rows.ndim == 0 else rows
+
+
+class Trace:
+    def __init__(self, path, meta, uniform=False):
+        self.path = path
+        self.meta = meta
+        self.rows = meta['rows']
+        for name in COLUMNS:
+            setattr(self, name, self._column(name))
+        # Computed times only where the sampling was found uniform
+        sampling = meta.get('sampling', {})
+        if uniform and self.rows and sampling.get('step') is not None:
+            self.time = UniformTime(sampling['start'], sampling['step'], self.rows)
+
+    def _column(self, name):
+        dtype = self.meta['dtypes'][name]
+        if self.rows == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name + '.bin'), dtype=dtype, mode='r', shape=(self.rows,))
+
+    def __len__(self):
+        return self.rows
+
+    @property
+    def uniform(self):
+        return isinstance(self.time, UniformTime)
+
+    def row_at(self, time):
+        """The first row at or after time (or each of an array of times): computed for uniform traces, by bisection otherwise."""
+        if self.uniform:
+            return self.time.row_at(time)
+        rows = np.searchsorted(self.time, time)
+        return int(rows) if np.ndim(rows) == 0 else rows
+
+    def chunks(self, rows=CHUNK // 8, progress=None):
+        """Yield (time, fluo, pmt) for consecutive blocks of rows, as read_chunks() does for the CSV."""
+        for start in range(0, self.rows, rows):
+            if progress is not None:
+                progress(start, self.rows)
+            yield self.time[start:start + rows], self.fluo[start:start + rows], self.pmt[start:start + rows]
+
+    def level(self, name, size):
+        return np.load(os.path.join(self.path, f'{name}.{size}.npy'), mmap_mode='r')
+
+    def envelope(self, name, start, stop, buckets):
+        """Min, max and mean of the rows [start, stop) of a column, in about buckets buckets.
+
+        Returns the central row of every bucket with its min, max and mean.
+        Ranges spanning several BUCKET per bucket are read from the pyramid,
+        shorter ones are reduced on the fly from the column itself.
+        """
+        start, stop = max(start, 0), min(stop, self.rows)
+        want = max(1, (stop - start) // max(buckets, 1))
+        sizes = [size for size in self.meta.get('levels', {}).get(name, []) if size <= want]
+        if sizes:
+            group = want // sizes[-1]
+            size = sizes[-1] * group
+            first = start // size
+            data = self.level(name, sizes[-1])[first * group:-(-stop // size) * group]
+            data = reduce_buckets(data[:, 0], data[:, 1], data[:, 2], group)
+        else:
+            size = want
+            first = start // size
+            column = getattr(self, name)[first * size:-(-stop // size) * size]
+            data = reduce_buckets(column, column, column, size)
+        rows = (first + np.arange(len(data))) * size
+        counts = np.minimum(size, self.rows - rows)
+        return rows + counts // 2, data[:, 0], data[:, 1], data[:, 2] / counts
+
+
+def reduce_buckets(lo, hi, total, size):
+    """Reduce consecutive groups of size rows to (min, max, sum) buckets."""
+    full = len(lo) - len(lo) % size
+    out = np.empty((-(-len(lo) // size), 3))
+    out[:full // size, 0] = np.asarray(lo[:full]).reshape(-1, size).min(axis=1)
+    out[:full // size, 1] = np.asarray(hi[:full]).reshape(-1, size).max(axis=1)
+    out[:full // size, 2] = np.asarray(total[:full]).reshape(-1, size).sum(axis=1)
+    if full < len(lo):
+        out[-1] = np.min(lo[full:]), np.max(hi[full:]), np.sum(total[full:])
+    return out
+
+
+@profiling.timed('pyramid')
+def build_levels(path, name, column):
+    """Write the pyramid of a column, from BUCKET rows per bucket up to TOP buckets."""
+    rows = len(column)
+    sources = (column, column, column)
+    step = size = BUCKET
+    sizes = []
+    while rows:
+        level = np.lib.format.open_memmap(os.path.join(path, f'{name}.{size}.npy'), mode='w+',
+                                          dtype=np.float64, shape=(-(-rows // size), 3))
+        block = step << 16
+        for a in range(0, len(sources[0]), block):
+            level[a // step:(a + block) // step] = reduce_buckets(*(s[a:a + block] for s in sources), step)
+        level.flush()
+        sizes.append(size)
+        if len(level) <= TOP:
+            break
+        sources = (level[:, 0], level[:, 1], level[:, 2])
+        step = FACTOR
+        size *= FACTOR
+    return sizes
+
+
+def load_meta(filename):
+    """Metadata of the cache of filename, or None if missing or stale."""
+    return read_meta(cache_path(filename), filename)
+
+
+def read_meta(path, filename):
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('version') != VERSION or meta.get('source') != source_stamp(filename):
+        return None
+    return meta
+
+
+def write_meta(path, meta):
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+
+def widen(path):
+    """Rewrite a float32 column file as float64."""
+    np.fromfile(path, dtype=np.float32).astype(np.float64).tofile(path)
+
+
+@profiling.timed('cache')
+def build_cache(filename, chunksize=CHUNK, progress=None):
+    """Build the cache of filename, checking whether its sampling is uniform."""
+    path = cache_path(filename)
+    tmp = path + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    stamp = source_stamp(filename)
+    files = {name: open(os.path.join(tmp, name + '.bin'), 'wb') for name in COLUMNS}
+    dtypes = {name: 'float32' if name in COMPACT else 'float64' for name in COLUMNS}
+    rows = 0
+    check = SamplingCheck()
+    try:
+        for columns in read_chunks(filename, chunksize, progress):
+            check.feed(columns[0])
+            for name, column in zip(COLUMNS, columns):
+                data = np.ascontiguousarray(column, dtype=dtypes[name])
+                if dtypes[name] == 'float32' and not np.array_equal(data, column, equal_nan=True):
+                    # Rare: values float32 cannot hold exactly, the column goes back to float64
+                    files[name].close()
+                    widen(files[name].name)
+                    files[name] = open(files[name].name, 'ab')
+                    dtypes[name] = 'float64'
+                    data = np.ascontiguousarray(column, dtype=np.float64)
+                data.tofile(files[name])
+            rows += len(columns[0])
+    except BaseException:
+        for f in files.values():
+            f.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    for f in files.values():
+        f.close()
+    meta = {'version': VERSION, 'source': stamp, 'rows': rows, 'dtypes': dtypes}
+    trace = Trace(tmp, meta)
+    meta['levels'] = {name: build_levels(tmp, name, getattr(trace, name)) for name in ('fluo', 'pmt')}
+    model = check.model(trace.time)
+    meta['sampling'] = {'start': model and model[0], 'step': model and model[1],
+                        'gaps': check.gaps, 'gapcount': check.gapcount}
+    del trace
+    write_meta(tmp, meta)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+    return meta
+
+
+def open_trace(filename, chunksize=CHUNK, progress=None, uniform=False):
+    """Open the cached columns of filename, building the cache on first use.
+
+    With uniform, the times of a uniformly sampled trace are computed from
+    the row index rather than read; meta['sampling'] lists any gaps found.
+    The stored times stay in the cache for the openings without uniform.
+    """
+    meta = load_meta(filename)
+    if meta is None:
+        meta = build_cache(filename, chunksize, progress)
+    return Trace(cache_path(filename), meta, uniform)
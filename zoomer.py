@@ -1,15 +1,65 @@
 import sys
+import os
+import time
 import numpy as np
 from PySide6.QtWidgets import (
     QApplication, QWidget, QPushButton, QVBoxLayout, QHBoxLayout, QFileDialog,
-    QLabel, QSpinBox, QSlider, QMessageBox, QDialog, QSizePolicy
+    QLabel, QSpinBox, QSlider, QMessageBox, QDialog, QSizePolicy, QProgressBar, QCheckBox
 )
-from PySide6.QtCore import Qt
-from scipy.signal import savgol_filter as savgol
+from PySide6.QtCore import Qt, QObject, QThread, Signal
 import pyqtgraph as pg
 import csv
+import itertools
+
+import engine
+import eventstore
+import profiling
+import render
+import resultcache
+import selection
+import tracefile
+
+class SelectionBox(pg.ViewBox):
+    # Left drags with Ctrl select a rectangle and with Shift draw a lasso,
+    # instead of zooming; the outline is emitted as a polygon when released
+    selected = Signal(object, object, bool)
+
+    def __init__(self):
+        super().__init__()
+        self.outline = pg.PlotCurveItem(pen=pg.mkPen('c'))
+        self.addItem(self.outline, ignoreBounds=True)
+        self.path = []
+        self.lasso = False
+
+    def mouseDragEvent(self, ev, axis=None):
+        modifiers = Qt.KeyboardModifier.ShiftModifier | Qt.KeyboardModifier.ControlModifier
+        if ev.isStart():
+            self.path = []
+            if ev.button() == Qt.MouseButton.LeftButton and ev.modifiers() & modifiers:
+                self.lasso = bool(ev.modifiers() & Qt.KeyboardModifier.ShiftModifier)
+                self.path = [self.mapSceneToView(ev.buttonDownScenePos())]
+        if not self.path:
+            return super().mouseDragEvent(ev, axis)
+        ev.accept()
+        position = self.mapSceneToView(ev.scenePos())
+        if self.lasso:
+            self.path.append(position)
+            px, py = [p.x() for p in self.path], [p.y() for p in self.path]
+        else:
+            (x0, y0), (x1, y1) = (self.path[0].x(), self.path[0].y()), (position.x(), position.y())
+            px, py = [x0, x1, x1, x0], [y0, y0, y1, y1]
+        self.outline.setData(px + px[:1], py + py[:1])
+        if ev.isFinish():
+            self.outline.setData([], [])
+            self.path = []
+            self.selected.emit(np.array(px), np.array(py), self.lasso)
 
 class RandomScatterPlotDialog(QDialog):
+    # Events can be picked with the slider, by hovering over the scatter or
+    # in groups with the Ctrl (rectangle) and Shift (lasso) drags, through a
+    # grid index of the points built when first needed
+    OVERLAY = 200
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle('Random Scatter Plot')
@@ -18,8 +68,10 @@ class RandomScatterPlotDialog(QDialog):
         layout = QVBoxLayout()
         
         innerlayout = QHBoxLayout()
-        self.plotWidget = pg.PlotWidget()
+        self.plotWidget = pg.PlotWidget(viewBox=SelectionBox())
         self.plotWidget.getViewBox().setMouseMode(pg.ViewBox.RectMode)        
+        self.plotWidget.getViewBox().selected.connect(self.selectEvents)
+        self.plotWidget.scene().sigMouseMoved.connect(self.hover)
         self.plotWidget.setLabel('left','Intensity [a.u.]')
         self.plotWidget.setLabel('bottom','Duration [us]')
         self.graphWidget = pg.PlotWidget()
@@ -40,48 +92,237 @@ class RandomScatterPlotDialog(QDialog):
         lowelayout.addWidget(QLabel('Intensity [a.u.]:'))
         self.Lpeak = QLabel('n/a')
         lowelayout.addWidget(self.Lpeak) 
+
+        selectLayout = QHBoxLayout()
+        self.selectionLabel = QLabel('Ctrl+drag: select a rectangle, Shift+drag: draw a lasso')
+        selectLayout.addWidget(self.selectionLabel)
+        self.showButton = QPushButton('Show selected')
+        self.showButton.clicked.connect(self.showSelection)
+        selectLayout.addWidget(self.showButton)
+        self.exportButton = QPushButton('Export selected')
+        self.exportButton.clicked.connect(self.exportSelection)
+        selectLayout.addWidget(self.exportButton)
         
         layout.addLayout(innerlayout)
         layout.addLayout(lowelayout)       
+        layout.addLayout(selectLayout)
         
         self.setLayout(layout)
         self.peaks=[]
+        self.selectedpeak.valueChanged.connect(self.updatePoint)
         self.generateRandomData()
 
-    def generateRandomData(self,x=None,y=None,data=None):
+    def generateRandomData(self,x=None,y=None,data=None,features=None):
         self.plotWidget.clear()
         self.graphWidget.clear()        
         if x is None:
             x = np.random.rand(1000)
             y = np.random.rand(1000)
-        self.selectedpeak.setMaximum(len(x)-1)
         self.x,self.y=x,y
         self.peaks=data
-        self.plotWidget.plot(x, y, pen=None, symbol='o', symbolSize=5)
+        self.features=features
+        self.index=None
+        self.selection=np.empty(0, dtype=np.intp)
+        self.scatter = self.plotWidget.plot(x, y, pen=None, symbol='o', symbolSize=5)
+        self.chosen = self.plotWidget.plot([], [], pen=None, symbol='o', symbolSize=5, symbolBrush='c')
         self.point = self.plotWidget.plot([x[0]],[y[0]],pen=None, symbol='o', symbolSize=5, symbolBrush='orange')
+        self.curve = self.graphWidget.plot([], [], pen='y',symbol='o',symbolSize=3)
+        self.selectedpeak.blockSignals(True)
+        self.selectedpeak.setMaximum(len(x)-1)
         self.selectedpeak.setValue(0)
-        self.selectedpeak.valueChanged.connect(self.updatePoint)
+        self.selectedpeak.blockSignals(False)
         self.updatePoint()
+
+    def appendData(self,x,y,data):
+        # Events arriving while a trace is followed
+        if len(x) == 0:
+            return
+        self.x,self.y = np.concatenate((self.x,x)),np.concatenate((self.y,y))
+        self.peaks = list(self.peaks)+list(data)
+        self.index = None
+        self.scatter.setData(self.x,self.y)
+        self.selectedpeak.setMaximum(len(self.x)-1)
         
     def updatePoint(self,value=0):
         # Update the point based on the selected peak value
         if self.peaks is not None:
             peak = self.peaks[value]
-            self.graphWidget.clear()
-            self.graphWidget.plot(peak[:,0],peak[:,1], pen='y',symbol='o',symbolSize=3)    
+            self.curve.setData(peak[:,0],peak[:,1],symbol='o')
         self.point.setData([self.x[value]], [self.y[value]])  # Assuming peaks is a list of (x, y) tuples    
         self.Lpeak.setText(f'{int(self.y[value])}')
         self.Lduration.setText(f'{int(self.x[value])}')
 
+    def eventIndex(self):
+        if self.index is None:
+            self.index = selection.EventIndex(self.x, self.y)
+        return self.index
+
+    def hover(self, position):
+        viewBox = self.plotWidget.getViewBox()
+        if not viewBox.sceneBoundingRect().contains(position):
+            return
+        point = viewBox.mapSceneToView(position)
+        width, height = viewBox.viewPixelSize()
+        k = self.eventIndex().nearest(point.x(), point.y(), 6*width, 6*height)
+        if k is not None and k != self.selectedpeak.value():
+            self.selectedpeak.setValue(k)
+
+    def selectEvents(self, px, py, lasso):
+        index = self.eventIndex()
+        self.selection = index.lasso(px, py) if lasso else index.rect(px.min(), px.max(), py.min(), py.max())
+        self.chosen.setData(self.x[self.selection], self.y[self.selection])
+        self.selectionLabel.setText(f'{len(self.selection)} events selected')
+
+    def showSelection(self):
+        # The samples of the selected events, read only now, overlaid from
+        # their first sample on
+        if self.peaks is None or len(self.selection) == 0:
+            return
+        shown = self.selection[:self.OVERLAY]
+        peaks = [self.peaks[k] for k in shown]
+        x = np.concatenate([np.append(peak[:,0]-peak[0,0], np.nan) for peak in peaks])
+        y = np.concatenate([np.append(peak[:,1], np.nan) for peak in peaks])
+        self.curve.setData(x, y, connect='finite', symbol=None)
+        self.selectionLabel.setText(f'{len(self.selection)} events selected, {len(shown)} shown')
+
+    def exportSelection(self):
+        if len(self.selection) == 0:
+            return
+        filePath, _ = QFileDialog.getSaveFileName(self, 'Export selected events', 'selection.csv',
+                                                  'CSV Files (*.csv);;NumPy (*.npz);;Parquet (*.parquet);;Feather (*.feather)')
+        if not filePath:
+            return
+        if self.features is not None:
+            rows, names = self.features[self.selection], engine.FEATURES
+        else:
+            rows, names = np.column_stack((self.x, self.y))[self.selection], engine.FEATURES[:2]
+        if eventstore.table_format(filePath):
+            eventstore.save_table(filePath, rows, names)
+            if self.peaks is not None:
+                peaks = [self.peaks[k] for k in self.selection]
+                offsets = np.zeros(len(peaks)+1, dtype=np.int64)
+                np.cumsum([len(peak) for peak in peaks], out=offsets[1:])
+                eventstore.save_samples(eventstore.samples_path(filePath), np.concatenate(peaks), offsets,
+                                        eventstore.SAMPLES[:2])
+        else:
+            with open(filePath, 'w', newline='') as csvfile:
+                csv.writer(csvfile).writerows(rows.tolist())
+        self.selectionLabel.setText(f'{len(self.selection)} events exported to {filePath}')
+
+class ThresholdSweepDialog(QDialog):
+    # Event count, mean duration and mean intensity against the threshold;
+    # the movable line picks the threshold handed back to the main window
+    def __init__(self, app):
+        super().__init__()
+        self.app = app
+        self.setWindowTitle('Threshold sweep')
+        self.setGeometry(200, 200, 600, 700)
+
+        layout = QVBoxLayout()
+        controlLayout = QHBoxLayout()
+        self.spinBoxes = []
+        for label, value in (('From:', 0), ('To:', 20000), ('Step:', 250)):
+            controlLayout.addWidget(QLabel(label))
+            spinBox = QSpinBox(self)
+            spinBox.setRange(0, 65535)
+            spinBox.setValue(value)
+            controlLayout.addWidget(spinBox)
+            self.spinBoxes.append(spinBox)
+        self.runButton = QPushButton('Run', self)
+        self.runButton.clicked.connect(self.runSweep)
+        controlLayout.addWidget(self.runButton)
+        self.useButton = QPushButton('Use threshold', self)
+        self.useButton.clicked.connect(self.useThreshold)
+        controlLayout.addWidget(self.useButton)
+        layout.addLayout(controlLayout)
+
+        self.plots = []
+        self.curves = []
+        self.lines = []
+        for label in ('Events', 'Mean duration [us]', 'Mean intensity [a.u.]'):
+            plot = pg.PlotWidget()
+            plot.setLabel('left', label)
+            plot.setLabel('bottom', 'Threshold [a.u.]')
+            if self.plots:
+                plot.setXLink(self.plots[0])
+            self.curves.append(plot.plot([], [], pen='y', symbol='o', symbolSize=4))
+            line = pg.InfiniteLine(pos=app.thresholdSpinBox.value(), movable=True, pen='b')
+            line.sigPositionChanged.connect(self.moveLines)
+            plot.addItem(line)
+            self.lines.append(line)
+            self.plots.append(plot)
+            layout.addWidget(plot)
+        self.setLayout(layout)
+
+    def runSweep(self):
+        start, stop, step = [spinBox.value() for spinBox in self.spinBoxes]
+        thresholds = np.arange(start, stop+1, max(step, 1))
+        self.app.sweepThresholds(thresholds, self.showSweep)
+
+    def showSweep(self, result):
+        thresholds, count, duration, intensity = result
+        for curve, values in zip(self.curves, (count, duration*1000, intensity)):
+            curve.setData(thresholds, values)
+
+    def moveLines(self, line):
+        for other in self.lines:
+            if other is not line:
+                other.setValue(line.value())
+
+    def useThreshold(self):
+        self.app.thresholdSpinBox.setValue(int(self.lines[0].value()))
+        self.accept()
+
+class Cancelled(Exception):
+    pass
+
+class Worker(QObject):
+    # Runs job(report) in a background thread; report(fraction, message)
+    # forwards the progress and raises Cancelled once cancel() was called
+    # Jobs taking a second argument get publish(result), delivered to the
+    # main thread as the partial signal while the job goes on
+    progress = Signal(int, str)
+    partial = Signal(object)
+    done = Signal(object)
+    failed = Signal(str)
+
+    def __init__(self, job, partial=False):
+        super().__init__()
+        self.job = job
+        self.publishing = partial
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def report(self, fraction, message):
+        if self.cancelled:
+            raise Cancelled()
+        self.progress.emit(int(fraction*1000), message)
+
+    def publish(self, result):
+        self.partial.emit(result)
+
+    def run(self):
+        try:
+            result = self.job(self.report, self.publish) if self.publishing else self.job(self.report)
+        except Cancelled:
+            self.failed.emit('')
+        except Exception as e:
+            self.failed.emit(str(e))
+        else:
+            self.done.emit(result)
+
 class MyApp(QWidget):
     def __init__(self):
         super().__init__()
         self.initUI()
         self.loaded = False
         self.finished=False
-        self.inmemory = False
         self.duration,self.intensity = [],[]
         self.safepeaks = []
+        self.jobThread = None
+        self.smoothCache = engine.SmoothCache()
         
     def initUI(self):
         self.setWindowTitle('AMK data analyser')
@@ -133,9 +374,17 @@ class MyApp(QWidget):
         self.prevButton.clicked.connect(self.prevWindow)
         controlLayout.addWidget(self.prevButton)
 
+        self.followButton = QPushButton('Follow', self)
+        self.followButton.clicked.connect(self.followTrace)
+        controlLayout.addWidget(self.followButton)
+
         self.isolateButton = QPushButton('Isolate', self)
         self.isolateButton.clicked.connect(self.isolatePeaks)
         controlLayout.addWidget(self.isolateButton)
+
+        self.sweepButton = QPushButton('Sweep', self)
+        self.sweepButton.clicked.connect(self.showThresholdSweep)
+        controlLayout.addWidget(self.sweepButton)
         
         self.saveButton = QPushButton('Save CSV', self)
         self.saveButton.clicked.connect(self.saveData)
@@ -143,6 +392,26 @@ class MyApp(QWidget):
         
 
         layout.addLayout(controlLayout)
+
+        progressLayout = QHBoxLayout()
+        self.progressBar = QProgressBar(self)
+        self.progressBar.setRange(0, 1000)
+        self.progressBar.setFormat('%p%')
+        progressLayout.addWidget(self.progressBar)
+        self.progressLabel = QLabel('', self)
+        progressLayout.addWidget(self.progressLabel)
+        self.cancelButton = QPushButton('Cancel', self)
+        self.cancelButton.setEnabled(False)
+        progressLayout.addWidget(self.cancelButton)
+        self.profileBox = QCheckBox('Profile', self)
+        self.profileBox.setChecked(profiling.enabled())
+        self.profileBox.toggled.connect(self.toggleProfile)
+        progressLayout.addWidget(self.profileBox)
+        layout.addLayout(progressLayout)
+
+        self.profileLabel = QLabel('', self)
+        self.profileLabel.setVisible(profiling.enabled())
+        layout.addWidget(self.profileLabel)
         
         self.sliding = QSlider(Qt.Orientation.Horizontal,self)
         self.sliding.setMinimum(0)
@@ -170,46 +439,136 @@ class MyApp(QWidget):
             self.filename= filePath
             self.loaded = False
             self.finished=False
-            self.inmemory = False
+            self.smoothCache.clear()
             self.loadAndPlotData()
             
+    def runInBackground(self, name, job, onDone, onPartial=None):
+        # Long jobs run in a QThread; their results come back to onDone on
+        # the main thread, through the jobDone slot
+        if self.jobThread is not None:
+            return
+        self.onDone = onDone
+        self.jobThread = QThread(self)
+        def staged(report, *publish):
+            with profiling.stage(name):
+                return job(report, *publish)
+        self.worker = Worker(staged, onPartial is not None)
+        if onPartial is not None:
+            self.worker.partial.connect(onPartial)
+        self.worker.moveToThread(self.jobThread)
+        self.jobThread.started.connect(self.worker.run)
+        self.worker.progress.connect(self.jobProgress)
+        self.worker.done.connect(self.jobDone)
+        self.worker.failed.connect(self.jobFailed)
+        # Directly: the worker's own thread is busy running the job
+        self.cancelButton.clicked.connect(self.worker.cancel, Qt.DirectConnection)
+        self.cancelButton.setEnabled(True)
+        for button in (self.selectButton, self.followButton, self.isolateButton, self.sweepButton, self.saveButton):
+            button.setEnabled(False)
+        self.progressBar.setValue(0)
+        self.jobThread.start()
+
+    def jobEnded(self):
+        self.cancelButton.clicked.disconnect(self.worker.cancel)
+        self.cancelButton.setEnabled(False)
+        for button in (self.selectButton, self.followButton, self.isolateButton, self.sweepButton, self.saveButton):
+            button.setEnabled(True)
+        self.jobThread.quit()
+        self.jobThread.wait()
+        self.jobThread = None
+        self.showProfile()
+
+    def toggleProfile(self, checked):
+        if checked:
+            profiling.profile.reset()
+            profiling.enable()
+        else:
+            profiling.disable()
+        self.profileLabel.setVisible(checked)
+        self.showProfile()
+
+    def showProfile(self):
+        if profiling.enabled():
+            self.profileLabel.setText(profiling.summary().replace('\n', '   '))
+
+    def jobProgress(self, value, message):
+        self.progressBar.setValue(value)
+        self.progressLabel.setText(message)
+
+    def jobDone(self, result):
+        self.jobEnded()
+        self.progressBar.setValue(1000)
+        self.onDone(result)
+
+    def jobFailed(self, message):
+        self.jobEnded()
+        self.progressBar.setValue(0)
+        self.progressLabel.setText('Cancelled' if not message else '')
+        if message:
+            QMessageBox.warning(self, 'Error', message)
+
     def saveData(self):        
         defaultName = self.filename.rsplit('.', 1)[0] + '_processed.csv'
-        filePath, _ = QFileDialog.getSaveFileName(self, 'Save CSV', defaultName, 'CSV Files (*.csv);;All Files (*)')
-        QApplication.setOverrideCursor(Qt.WaitCursor)
+        filePath, _ = QFileDialog.getSaveFileName(self, 'Save CSV', defaultName,
+                                                  'CSV Files (*.csv);;NumPy (*.npz);;Parquet (*.parquet);;Feather (*.feather);;All Files (*)')
         if not filePath:
             return
         if self.finished is False: 
             QMessageBox.warning(self, 'Warning', 'Please do isolate the peaks first.')
             return
-        #if len(self.duration) == 0:
-        self.calculateFeatures()
-        with open(filePath, 'w', newline='') as csvfile:
+        win = self.winSpinBox.value()
+        if win%2 == 0:
+            win+=1
+        self.runInBackground('saveData', lambda report: self.writeData(filePath, win, report), self.dataSaved)
+
+    def writeData(self, filePath, win, report):
+        self.calculateFeatures(win)
+        rows = self.features
+        if eventstore.table_format(filePath):
+            # Columnar outputs are written in one go, with the samples of every event
+            report(0, f'saving {len(rows)} events')
+            with profiling.stage('write'):
+                eventstore.save_table(filePath, rows, engine.FEATURES)
+                values, offsets = engine.ragged_samples((self.xtime, self.xfluo, self.xpmt), self.starts, self.ends)
+                eventstore.save_samples(eventstore.samples_path(filePath), values, offsets)
+            return filePath
+        step = 100000
+        with open(filePath, 'w', newline='') as csvfile, profiling.stage('write'):
             csvwriter = csv.writer(csvfile)
-            for duration, intensity in zip(self.duration, self.intensity):
-                csvwriter.writerow([duration, intensity])
-        QApplication.restoreOverrideCursor()
+            for start in range(0, len(rows), step):
+                report(start/len(rows), f'{start} of {len(rows)} events saved')
+                csvwriter.writerows(rows[start:start+step].tolist())
+        return filePath
+
+    def dataSaved(self, filePath):
+        self.progressLabel.setText(f'{len(self.duration)} events saved')
         QMessageBox.information(self, 'Data Saved', f'Data successfully saved to {filePath}.')
 
     def loadAndPlotData(self):        
-        QApplication.setOverrideCursor(Qt.WaitCursor)
-        self.line_offset = []
-        f = open(self.filename)
-        offset = 0
-        for line in f:
-            self.line_offset.append(offset)
-            offset += len(line)+1
-        endtime,tmpfluo=[float(number) for number in line.strip().split(',')[:2]]
-        f.close()
-        self.number = len(self.line_offset)-1
-        self.acqtime = (endtime)/(self.number-1)        
+        filename = self.filename
+        self.runInBackground('loadAndPlotData', lambda report: self.openTrace(filename, report), self.fileLoaded)
+
+    def openTrace(self, filename, report):
+        return tracefile.open_trace(filename, progress=lambda done, total: report(done/total, f'{done} of {total} bytes read'),
+                                    uniform=True)
+
+    def setTrace(self, trace):
+        self.trace = trace
+        self.number = self.trace.rows
+        self.acqtime = float(self.trace.time[-1])/(self.number-1)
+
+    def fileLoaded(self, trace):
+        self.setTrace(trace)
+        endtime = float(self.trace.time[-1])
         self.range=[1,self.number]
         N = self.pointsSpinBox.value()
         self.pointsSpinBox.setMaximum(self.number)
         self.pointsSpinBox.setMinimum(100)
         self.sliding.setMaximum(self.number-N-1)   
-        QApplication.restoreOverrideCursor()
-        QMessageBox.information(self, 'File loaded', f'File {self.filename} opened.\nA total of {self.number} lines has been read.\nTotal acquisition time of the track: {int(endtime/10)/100}s\nAcquisition time {int(self.acqtime*1e5)/100}us')
+        self.progressLabel.setText(f'{self.number} lines loaded')
+        sampling = self.trace.meta['sampling']
+        gaps = f'\n{sampling["gapcount"]} sampling gaps, the first at row {sampling["gaps"][0][0]}' if sampling['gaps'] else ''
+        QMessageBox.information(self, 'File loaded', f'File {self.filename} opened.\nA total of {self.number} lines has been read.\nTotal acquisition time of the track: {int(endtime/10)/100}s\nAcquisition time {int(self.acqtime*1e5)/100}us{gaps}')
         
         self.messageLabel.setText(f'Loaded file: {self.filename}')        
         
@@ -238,12 +597,14 @@ class MyApp(QWidget):
             if self.finished is True:
                 self.plotWidget1.setXRange(*range, padding=0)
                 self.plotWidget2.setXRange(*range, padding=0)
-                self.range=[int(range[0]/self.acqtime),min(int(range[1]/self.acqtime),len(self.line_offset)-1)]
+                self.range=[self.trace.row_at(range[0]),min(self.trace.row_at(range[1]),self.number)]
+                with profiling.stage('updatePlot'):
+                    self.drawIsolated(*range)
             return
         self.loaded = False
         self.plotWidget1.setXRange(*range, padding=0)
         self.plotWidget2.setXRange(*range, padding=0)
-        self.range=[int(range[0]/self.acqtime),min(int(range[1]/self.acqtime),len(self.line_offset)-1)]
+        self.range=[self.trace.row_at(range[0]),min(self.trace.row_at(range[1]),self.number)]
         self.loaded = True
         self.updatePlot()
         
@@ -256,66 +617,98 @@ class MyApp(QWidget):
     def updatePlot(self):
         if self.loaded is False:
             return
+        with profiling.stage('updatePlot'):
+            self.drawRange()
+        self.showProfile()
+
+    def drawRange(self):
         win = self.winSpinBox.value()
         if win%2 == 0:
             win+=1
         N = self.pointsSpinBox.value()
         #position = self.sliding.value() #change here for the starting position of the slice in ms
-        f = open(self.filename)
-        time=[]
-        fluo=[]
-        pmt=[]
-        for position in np.linspace(self.range[0],self.range[1],N):
-            f.seek(self.line_offset[int(position)])
-            riga = f.readline()
-            tmptime,tmpfluo,tmppmt=[float(number) for number in riga.strip().split(',')[:3]]
-            time.append(tmptime)
-            fluo.append(tmpfluo)
-            pmt.append(tmppmt)
-        f.close()
+        # Each of the N buckets is drawn as its min and max, so that no peak
+        # is lost however far out the view is zoomed
+        rows,fluolo,fluohi,fluo = self.trace.envelope('fluo',self.range[0]-1,self.range[1],N)
+        rows,pmtlo,pmthi,pmt = self.trace.envelope('pmt',self.range[0]-1,self.range[1],N)
+        time = self.trace.time[rows]
+        if len(rows) >= win:
+            fluo,pmt = engine.smooth(fluo,win),engine.smooth(pmt,win)
 
         self.loaded = False
-        self.line1.setData(time, fluo)
-        self.fit1.setData(time,savgol(fluo,win,1))
+        shape = render.symbol(self.range[1]-self.range[0]+1, self.pixels())
+        self.line1.setSymbol(shape)
+        self.line2.setSymbol(shape)
+        self.line1.setData(np.repeat(time,2), np.column_stack((fluolo,fluohi)).ravel())
+        self.fit1.setData(time,fluo)
         th=self.thresholdSpinBox.value()
         self.threshline.setData([min(time),max(time)],[th,th])
         #self.plotWidget1.autoRange()
-        self.line2.setData(time, pmt)
-        self.fit2.setData(time, savgol(pmt,win,1), pen='y')
+        self.line2.setData(np.repeat(time,2), np.column_stack((pmtlo,pmthi)).ravel())
+        self.fit2.setData(time, pmt, pen='y')
         #self.plotWidget2.autoRange()
         self.loaded=True
+
+    def pixels(self):
+        return max(int(self.plotWidget1.getViewBox().width()), 100)
+
+    def drawIsolated(self, lo=None, hi=None):
+        # Only the isolated points in view are drawn, decimated to the pixel
+        # columns, with the fit smoothed over them alone
+        if len(self.xtime) == 0:
+            return
+        if lo is None:
+            lo, hi = self.xtime[0], self.xtime[-1]
+        pixels = self.pixels()
+        curves = ((self.line1, self.fit1, self.xfluo), (self.line2, self.fit2, self.xpmt))
+        for (line, fit, values), (levels, fitlevels) in zip(curves, self.levels):
+            x, y, count = render.decimate(self.xtime, values, lo, hi, pixels, levels)
+            line.setSymbol(render.symbol(count, pixels))
+            line.setData(x, y)
+            fit.setData(*render.fit(self.xtime, values, lo, hi, self.fitwin, pixels, fitlevels))
         
-    def calculateFeatures(self):
-        win = self.winSpinBox.value()
-        if win%2 == 0:
-            win+=1
-        peaks=[]
-        prevtime=0
-        tmp=[]
-        for i in range(1,len(self.xtime)):
-            time = self.xtime[i]
-            fluo = self.xfluo[i]
-            if int((time-prevtime)*1000) > int(self.acqtime*1000):
-                if len(tmp)>win:
-                    peaks.append(np.array(tmp))
-                tmp=[]                    
-            else:                
-                tmp.append([time,fluo])        
-            prevtime = time
-        intensity= []
-        duration = []
-        for p in peaks:
-            intensity.append(np.max(savgol(p[:,1],win,1)))
-            duration.append((p[-1,0]-p[0,0])*1000)            
-        self.duration,self.intensity = duration,intensity
-        self.safepeaks = peaks
+    @profiling.timed()
+    def calculateFeatures(self, win=None):
+        if win is None:
+            win = self.winSpinBox.value()
+            if win%2 == 0:
+                win+=1
+        acqtimeus = int(self.acqtime*1000)
+        starts,ends = self.starts,self.ends = engine.split_events(self.xtime,win,acqtimeus)
+        # The same table as batch.py's for these settings, shared through the
+        # cache of results; not so when the points were isolated with another
+        # window than the one splitting them into events
+        cache = resultcache.ResultCache() if win == self.fitwin else None
+        key = cache and resultcache.run_key(self.filename,self.threshold,win,acqtimeus,engine.FEATURES,
+                                            self.trace.uniform)
+        found = cache and cache.get(key)
+        if found:
+            self.features = found[0]
+        else:
+            start = time.perf_counter()
+            self.features = engine.event_features(self.xtime,self.xfluo,self.xpmt,starts,ends,win)
+            if cache:
+                cache.put(key,self.features,{'source':os.path.abspath(self.filename),'threshold':self.threshold,
+                                             'window':win,'features':list(engine.FEATURES),
+                                             'uniform':self.trace.uniform,'samples':self.trace.rows,
+                                             'events':len(starts),'elapsed':time.perf_counter()-start})
+        # Times and areas in us, as the durations have always been saved
+        self.features *= [eventstore.SCALE if name in eventstore.SCALED else 1 for name in engine.FEATURES]
+        self.duration,self.intensity = self.features[:,0],self.features[:,1]
+        # Every event spans the rows of the trace from its first to its last
+        # sample, short dips below the threshold included: its samples are
+        # read from the cache only when shown
+        first = self.trace.row_at(self.xtime[starts])
+        last = self.trace.row_at(self.xtime[ends-1])
+        self.safepeaks = engine.event_samples(self.trace.time,self.trace.fluo,first,last+1)
+        profiling.count('events',len(starts))
 
     def showRandomScatterPlot(self):
         dialog = RandomScatterPlotDialog()        
             
         if self.finished is True:        
             self.calculateFeatures()
-            dialog.generateRandomData(self.duration,self.intensity,self.safepeaks)
+            dialog.generateRandomData(self.duration,self.intensity,self.safepeaks,self.features)
             
         dialog.exec_()
 
@@ -329,43 +722,123 @@ class MyApp(QWidget):
         win = self.winSpinBox.value()
         if win%2 == 0:
             win+=1
-        QApplication.setOverrideCursor(Qt.WaitCursor)     
-        self.loaded=False        
-        self.finished=True
-        if self.inmemory is False:
-            f = open(self.filename)
-            self.memfluo=[]
-            self.mempmt=[]
-            self.memtime=[]
-            f.readline()
-            for riga in f:
-                tmptime,tmpfluo,tmppmt=[float(number) for number in riga.strip().split(',')[:3]]
-                self.memtime.append(tmptime)
-                self.memfluo.append(tmpfluo)
-                self.mempmt.append(tmppmt)
-            f.close()   
-            self.inmemory = True    
-             
-        filtered = savgol(self.memfluo,win,1)
         threshold = self.thresholdSpinBox.value()
-    
-        block = np.where(filtered>threshold)
-        
-        self.xtime = np.array(self.memtime)[block]
-        self.xfluo = np.array(self.memfluo)[block]
-        self.xpmt = np.array(self.mempmt)[block]
+        self.runInBackground('isolatePeaks', lambda report: self.isolate(win, threshold, report), self.peaksIsolated)
+
+    def smoothed(self, win, report):
+        trace = self.trace
+        step = tracefile.CHUNK // 8
+        def chunks():
+            for start in range(0, trace.rows, step):
+                report(start/trace.rows, f'{start} of {trace.rows} points smoothed')
+                yield trace.time[start:start+step], trace.fluo[start:start+step], trace.pmt[start:start+step]
+        # The smoothed trace only depends on the window: changing the
+        # threshold alone reuses it and its ranking
+        return self.smoothCache.get((trace.path, win),
+                                    lambda: np.concatenate([part[3] for part in engine.smooth_chunks(chunks(), win)]))
+
+    def isolate(self, win, threshold, report):
+        trace = self.trace
+        block = self.smoothed(win, report).above(threshold)
+        report(1, f'{len(block)} points isolated')
+        profiling.count('points isolated', len(block))
+        xtime = trace.time[block]
+        xfluo = trace.fluo[block]
+        xpmt = trace.pmt[block]
+        events = np.sum( (xtime[1:]-xtime[:-1])>self.acqtime )
+        report(1, f'{len(block)} points isolated, {events} events found')
+        # Pyramids of the curves and of their fits, to draw the wide views from
+        levels = [(render.pyramid(values), render.pyramid(engine.smooth(values, win)) if len(values) >= win else [])
+                  for values in (xfluo, xpmt)]
+        return win, threshold, xtime, xfluo, xpmt, levels, events
+
+    def followTrace(self):
+        # A trace still being written is analysed as it grows: the events are
+        # appended to <trace>_processed.csv and to the scatter plot as they close
+        filePath, _ = QFileDialog.getOpenFileName(self, 'Follow CSV', '', 'CSV Files (*.csv);;All Files (*)')
+        if not filePath:
+            return
+        win = self.winSpinBox.value()
+        if win%2 == 0:
+            win+=1
+        threshold = self.thresholdSpinBox.value()
+        outfile = filePath.rsplit('.', 1)[0] + '_processed.csv'
+        self.liveDialog = RandomScatterPlotDialog()
+        self.liveDialog.setWindowTitle(f'Following {filePath}')
+        self.liveDialog.peaks = None
+        self.liveDialog.show()
+        self.runInBackground('followTrace', lambda report, publish: self.follow(filePath, outfile, win, threshold, report, publish),
+                             self.traceFollowed, self.eventsArrived)
+
+    def follow(self, filename, outfile, win, threshold, report, publish):
+        chunks = tracefile.follow(filename, wait=lambda: report(0, 'waiting for data'))
+        first = next(chunks)
+        while len(first[0]) < 2:
+            first = tuple(np.concatenate(c) for c in zip(first, next(chunks)))
+        events = engine.EventStream(threshold, win, int((first[0][1]-first[0][0])*1000), keep=True)
+        scale = [eventstore.SCALE if name in eventstore.SCALED else 1 for name in engine.FEATURES]
+        with open(outfile, 'w', newline='') as csvfile:
+            csvwriter = csv.writer(csvfile)
+            for time, fluo, pmt, filtered in engine.smooth_chunks(itertools.chain([first], chunks), win):
+                table = events.feed(time, fluo, pmt, filtered)*scale
+                report(0, f'{events.samples} points read, {events.count} events')
+                if len(table) == 0:
+                    continue
+                csvwriter.writerows(table.tolist())
+                csvfile.flush()
+                values, offsets = engine.join_ragged(events.kept)
+                events.kept.clear()
+                publish((table[:,0], table[:,1], np.split(values[:,:2], offsets[1:-1])))
+        return outfile, events.count
+
+    def eventsArrived(self, result):
+        duration, intensity, peaks = result
+        if self.liveDialog.peaks is None:
+            self.liveDialog.generateRandomData(duration, intensity, peaks)
+        else:
+            self.liveDialog.appendData(duration, intensity, peaks)
+
+    def traceFollowed(self, result):
+        outfile, count = result
+        self.progressLabel.setText(f'{count} events saved to {outfile}')
+
+    def showThresholdSweep(self):
+        if self.loaded is False and self.finished is False:
+            QMessageBox.warning(self, 'Warning', 'Please open a file first.')
+            return
+        dialog = ThresholdSweepDialog(self)
+        dialog.exec_()
+
+    def sweepThresholds(self, thresholds, onDone):
+        win = self.winSpinBox.value()
+        if win%2 == 0:
+            win+=1
+        acqtimeus = int(self.acqtime*1000)
+        def job(report):
+            ranked = self.smoothed(win, report)
+            count,duration,intensity = engine.sweep(ranked, self.trace.time, self.trace.fluo, thresholds, win, acqtimeus,
+                                                    lambda done, total: report(done/total, f'{done} of {total} thresholds'))
+            report(1, f'{len(thresholds)} thresholds swept')
+            return thresholds, count, duration, intensity
+        self.runInBackground('sweepThresholds', job, onDone)
+
+    def setIsolated(self, result):
+        self.fitwin, self.threshold, self.xtime, self.xfluo, self.xpmt, self.levels, events = result
+        self.finished=True
+        return events
+
+    def peaksIsolated(self, result):
+        events = self.setIsolated(result)
+        self.loaded=False        
         
-        self.line1.setData(self.xtime, self.xfluo)
-        self.fit1.setData(self.xtime,savgol(self.xfluo,win,1))
+        self.fit2.setPen('y')
+        self.drawIsolated()
         th=self.thresholdSpinBox.value()
         self.threshline.setData([min(self.xtime),max(self.xtime)],[th,th])
         self.plotWidget1.autoRange()
-        self.line2.setData(self.xtime, self.xpmt)
-        self.fit2.setData(self.xtime, savgol(self.xpmt,win,1), pen='y')
         self.plotWidget2.autoRange()
         
-        QApplication.restoreOverrideCursor()        
-        QMessageBox.information(self, 'File analysed', f'A total of {len(self.xtime)} points lay above the smoothed threshold, corresponding to {np.sum( (self.xtime[1:]-self.xtime[:-1])>self.acqtime )} events.')
+        QMessageBox.information(self, 'File analysed', f'A total of {len(self.xtime)} points lay above the smoothed threshold, corresponding to {events} events.')
         
 
 if __name__ == '__main__':